@@ -0,0 +1,102 @@
+# Compares the per frame keyframe_insert loop formerly used by transform_store
+# with the batched F-Curve writer, and checks the batched rotation channels
+# against Matrix.decompose() on half turns around mixed sign axes.
+#
+# Usage:
+#   blender --background --factory-startup --python benchmarks/transform_bake.py -- [frames] [--no-numpy]
+
+import bpy
+import importlib
+import math
+import mathutils
+import os
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(root))
+bla = importlib.import_module(os.path.basename(root) + '.blatools')
+bmat = importlib.import_module(os.path.basename(root) + '.blatools_matrix')
+
+def matrices_make(count):
+    matrices = []
+    for f in range(count):
+        matrices.append(
+            mathutils.Matrix.Translation((math.sin(f * 0.1), f * 0.01, math.cos(f * 0.1)))
+            @ mathutils.Euler((f * 0.02, f * 0.03, f * 0.05)).to_matrix().to_4x4()
+            @ mathutils.Matrix.Diagonal((1.0, 1.0 + f * 0.001, 1.0, 1.0))
+        )
+    return matrices
+
+def empty_new(name):
+    empty = bpy.data.objects.new(name, None)
+    bpy.context.scene.collection.objects.link(empty)
+    return empty
+
+def bake_insert(frames, matrices):
+    empty = empty_new('BENCH-insert')
+    group = 'Object Transforms'
+    for f, m in zip(frames, matrices):
+        empty.matrix_world = m
+        empty.keyframe_insert('location', frame=f, group=group)
+        empty.keyframe_insert('rotation_euler', frame=f, group=group)
+        empty.keyframe_insert('scale', frame=f, group=group)
+    return empty
+
+def bake_batched(frames, matrices):
+    empty = empty_new('BENCH-batched')
+    bla.fcurves_bake(empty, frames, bmat.matrices_new(matrices))
+    return empty
+
+def rotations_check():
+    # Half turns have w close to 0, the signs of x, y and z must survive
+    matrices = []
+    for axis in ((1, -1, 0), (1, -1, 1), (-1, 1, 1), (0, 1, -1), (-1, -2, 3), (1, 0, 0)):
+        for angle in (math.pi, math.pi - 1e-4, math.pi * 0.5):
+            quat = mathutils.Quaternion(mathutils.Vector(axis).normalized(), angle)
+            matrices.append(mathutils.Matrix.Translation((1.0, 2.0, 3.0)) @ quat.to_matrix().to_4x4())
+    batch = bmat.matrices_new(matrices)
+    quats = zip(*bmat.matrices_channels(batch, 'QUATERNION')['rotation_quaternion'])
+    axis_angles = zip(*bmat.matrices_channels(batch, 'AXIS_ANGLE')['rotation_axis_angle'])
+    error = 0.0
+    for m, quat, axis_angle in zip(matrices, quats, axis_angles):
+        ref = m.decompose()[1]
+        for q in (mathutils.Quaternion(quat), mathutils.Quaternion(axis_angle[1:], axis_angle[0])):
+            angle = q.rotation_difference(ref).angle
+            error = max(error, min(angle, 2.0 * math.pi - angle))
+    print("rotation error %g" % error)
+
+def main():
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    numbers = [a for a in argv if not a.startswith('--')]
+    count = int(numbers[0]) if numbers else 2000
+    if '--no-numpy' in argv:
+        bmat.numpy = None
+    frames = [float(f) for f in range(1, count + 1)]
+    matrices = matrices_make(count)
+
+    results = {}
+    for name, bake in (('insert', bake_insert), ('batched', bake_batched)):
+        start = time.perf_counter()
+        results[name] = bake(frames, matrices)
+        print("%-8s %8.3f s" % (name, time.perf_counter() - start))
+
+    # Both paths have to produce the same transforms, euler values may differ
+    error = 0.0
+    for f in frames[::max(1, count // 100)]:
+        m = []
+        for empty in results.values():
+            fcurves = empty.animation_data.action.fcurves
+            values = [fcurves.find(p, index=i).evaluate(f) for p in ('location', 'rotation_euler', 'scale') for i in range(3)]
+            m.append(
+                mathutils.Matrix.Translation(values[0:3])
+                @ mathutils.Euler(values[3:6]).to_matrix().to_4x4()
+                @ mathutils.Matrix.Diagonal(values[6:9] + [1.0])
+            )
+        error = max(error, max(abs(a - b) for row_a, row_b in zip(*m) for a, b in zip(row_a, row_b)))
+    print("max error %g" % error)
+
+    rotations_check()
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,17 @@
 import bpy
+import array
+import bisect
 import copy
+import fnmatch
+import json
+import math
+import os
 import re
 import unicodedata
 import mathutils
 
+from . import blatools_matrix as bmat
+
 def ui_redraw():
     """Forces blender to redraw its UI.
     Returns: None.
@@ -54,6 +62,646 @@ def motionpaths_auto(context, use_tails=False, use_preview_range=True):
             start_frame=start,
             end_frame=end
         )
+    motionpaths_snapshot(context, use_tails)
+
+motionpaths_snapshots = {}
+
+def motionpaths_targets(context):
+    """Gets the selected pose bones in pose mode or the selected objects otherwise.
+    Returns: List of (object, pose bone or None).
+    """
+    if context.mode == 'POSE':
+        return [(pb.id_data, pb) for pb in context.selected_pose_bones]
+    return [(obj, None) for obj in context.selected_objects]
+
+def motionpaths_keys(obj, bone=None):
+    """Reads the keyframes of all transform F-Curves the motion path of an object or pose
+    bone depends on: its own, the ones of parent bones and the ones of parent objects.
+    Returns: Dictionary of (action pointer, data path, array index) to keyframe data.
+    """
+    keys = {}
+    owners = {''}
+    if bone:
+        owners.update(b.name for b in [bone] + list(bone.parent_recursive))
+    parent = obj
+    while parent:
+        action = parent.animation_data.action if parent.animation_data else None
+        if action:
+            index = action_index(action)
+            for owner in owners.intersection(index):
+                for data_path, array_index in index[owner]['channels']:
+                    fc = action.fcurves.find(data_path, index=array_index)
+                    count = len(fc.keyframe_points) * 2
+                    co = array.array('f', [0.0]) * count
+                    left = array.array('f', [0.0]) * count
+                    right = array.array('f', [0.0]) * count
+                    interpolation = array.array('i', [0]) * (count // 2)
+                    fc.keyframe_points.foreach_get('co', co)
+                    fc.keyframe_points.foreach_get('handle_left', left)
+                    fc.keyframe_points.foreach_get('handle_right', right)
+                    fc.keyframe_points.foreach_get('interpolation', interpolation)
+                    keys[(action.as_pointer(), data_path, array_index)] = {
+                        'extrapolation': fc.extrapolation,
+                        'modifiers': len(fc.modifiers),
+                        'keys': {
+                            co[i * 2]: (co[i * 2 + 1], left[i * 2], left[i * 2 + 1], right[i * 2], right[i * 2 + 1], interpolation[i])
+                            for i in range(count // 2)
+                        }
+                    }
+        parent = parent.parent
+        owners = {''}
+    return keys
+
+def motionpaths_snapshot(context, use_tails=False):
+    """Records the keyframes the motion paths of the selection depend on, to find what
+    changed when updating them.
+    Returns: None.
+    """
+    for obj, bone in motionpaths_targets(context):
+        motionpaths_snapshots[(obj.as_pointer(), bone.name if bone else '')] = {
+            'tails': use_tails and bone is not None,
+            'keys': motionpaths_keys(obj, bone)
+        }
+
+def motionpaths_windows(old, new):
+    """Compares two keyframe snapshots. Every edited, added or removed key affects the
+    frames between its neighbouring keys, before and after the edit.
+    Returns: Merged list of (start, end) frame ranges, None if the whole path is affected.
+    """
+    windows = []
+    for channel in set(old).union(new):
+        o = old.get(channel)
+        n = new.get(channel)
+        if o == n:
+            continue
+        if o is None or n is None or o['modifiers'] or n['modifiers'] or o['extrapolation'] != n['extrapolation']:
+            return None
+        o_frames = sorted(o['keys'])
+        n_frames = sorted(n['keys'])
+        for frame in set(o_frames).union(n_frames):
+            if o['keys'].get(frame) == n['keys'].get(frame):
+                continue
+            start = frame
+            end = frame
+            for frames in (o_frames, n_frames):
+                i = bisect.bisect_left(frames, frame)
+                start = min(start, frames[i - 1] if i > 0 else -math.inf)
+                i = bisect.bisect_right(frames, frame)
+                end = max(end, frames[i] if i < len(frames) else math.inf)
+            windows.append((start, end))
+
+    merged = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def motionpaths_update(context):
+    """Recomputes only the frames of the selected motion paths affected by keyframe edits
+    since they were calculated and splices them into the existing paths. If any path was
+    not calculated by motionpaths_auto, all of them get calculated again.
+    Returns: Number of recomputed frames, None if the paths were calculated again.
+    """
+    samples = []
+    for obj, bone in motionpaths_targets(context):
+        path = (bone or obj).motion_path
+        snapshot = motionpaths_snapshots.get((obj.as_pointer(), bone.name if bone else ''))
+        if path is None or snapshot is None:
+            motionpaths_auto(context)
+            return None
+        keys = motionpaths_keys(obj, bone)
+        windows = motionpaths_windows(snapshot['keys'], keys)
+        snapshot['keys'] = keys
+        start = path.frame_start
+        end = path.frame_end - 1
+        if windows is None:
+            windows = [(start, end)]
+        frames = set()
+        for window_start, window_end in windows:
+            frames.update(range(math.ceil(max(start, window_start)), math.floor(min(end, window_end)) + 1))
+        if frames:
+            samples.append((obj, bone, [float(f) for f in sorted(frames)], path, snapshot['tails']))
+
+    count = 0
+    results = transform_sample(context, [sample[:3] for sample in samples])
+    for (obj, bone, frames, path, tails), matrices in zip(samples, results):
+        offset = mathutils.Vector((0.0, bone.bone.length if tails else 0.0, 0.0))
+        for f, m in zip(frames, bmat.matrices_list(matrices)):
+            path.points[int(f) - path.frame_start].co = m @ offset
+        count += len(frames)
+    ui_redraw()
+    return count
+
+action_indices = {}
+
+def action_index(action):
+    """Indexes the transform F-Curves of an action by their owner, '' being the object
+    itself and any other key a bone name. Every owner maps to its channels as
+    (data path, array index) and to a sorted list of its unique keyframe frames.
+    The index is cached until the action changes.
+    Returns: Dictionary.
+    """
+    key = action.as_pointer()
+    signature = len(action.fcurves)
+    cached = action_indices.get(key)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    transform_props = (
+        'location',
+        'rotation_euler',
+        'rotation_quaternion',
+        'rotation_axis_angle',
+        'scale'
+    )
+    owners = {}
+    for fc in action.fcurves:
+        data_path = fc.data_path
+        if data_path.startswith('pose.bones["'):
+            split = data_path.rfind('"].')
+            if split == -1:
+                continue
+            owner = data_path[12:split]
+            prop = data_path[split + 3:]
+        else:
+            owner = ''
+            prop = data_path
+        if prop not in transform_props:
+            continue
+        if owner not in owners:
+            owners[owner] = {'channels': [], 'frames': set()}
+        owners[owner]['channels'].append((data_path, fc.array_index))
+        co = array.array('f', [0.0]) * (len(fc.keyframe_points) * 2)
+        fc.keyframe_points.foreach_get('co', co)
+        owners[owner]['frames'].update(co[0::2])
+
+    for owner in owners.values():
+        owner['frames'] = sorted(owner['frames'])
+    action_indices[key] = (signature, owners)
+    return owners
+
+def action_keys(action, owner='', range_min=None, range_max=None):
+    """Looks up the unique keyframe frames of an object ('') or bone in an action,
+    optionally limited to a frame range.
+    Returns: Sorted list of frames.
+    """
+    index = action_index(action)
+    if owner not in index:
+        return []
+    frames = index[owner]['frames']
+    start = 0 if range_min is None else bisect.bisect_left(frames, range_min)
+    end = len(frames) if range_max is None else bisect.bisect_right(frames, range_max)
+    return frames[start:end]
+
+rest_matrices_cache = {}
+
+def rest_matrices(armature):
+    """Caches the rest matrices of all bones of an armature along with their inverses.
+    The cache is dropped whenever the armature data gets updated, nothing is cached
+    while it is being edited.
+    Returns: Dictionary of bone name: (matrix, inverted matrix).
+    """
+    key = armature.as_pointer()
+    cached = rest_matrices_cache.get(key)
+    if cached is None or len(cached) != len(armature.bones):
+        cached = {}
+        for bone in armature.bones:
+            m = bone.matrix_local.copy()
+            cached[bone.name] = (m, m.inverted())
+        if not armature.is_editmode:
+            rest_matrices_cache[key] = cached
+    return cached
+
+bone_indices_cache = {}
+
+def bone_indices(armature):
+    """Maps the bone names of an armature to their indices in armature.bones.
+    Bones are only added or removed in edit mode, renames are caught by the
+    message bus, both drop the cache.
+    Returns: Dictionary of bone name: index.
+    """
+    key = armature.as_pointer()
+    indices = bone_indices_cache.get(key)
+    if indices is None or len(indices) != len(armature.bones):
+        indices = {bone.name: i for i, bone in enumerate(armature.bones)}
+        if not armature.is_editmode:
+            bone_indices_cache[key] = indices
+    return indices
+
+def bone_names_changed(*args):
+    """Drops all caches keyed by bone names, called by the message bus on renames.
+    Returns: None.
+    """
+    bone_indices_cache.clear()
+    rest_matrices_cache.clear()
+
+bone_patterns = {}
+bone_patterns_cache = {}
+
+def bone_pattern(mode, pattern):
+    """Compiles a glob or regex bone name pattern once. Glob patterns may be separated
+    by commas and have to match whole names, regex patterns match anywhere in names.
+    Returns: Match function.
+    """
+    key = (mode, pattern)
+    match = bone_patterns.get(key)
+    if match is None:
+        if mode == 'GLOB':
+            globs = [glob.strip() for glob in pattern.split(',') if glob.strip()]
+            match = re.compile('|'.join(fnmatch.translate(glob) for glob in globs) or '(?!)').match
+        else:
+            match = re.compile(pattern).search
+        bone_patterns[key] = match
+    return match
+
+def bone_names_match(armature, mode, pattern):
+    """Finds the bone names of an armature matching a glob or regex pattern. Results
+    are cached along with the bone index map, so they last until bone names change.
+    Returns: List of bone names.
+    """
+    indices = bone_indices(armature)
+    key = armature.as_pointer()
+    cached = bone_patterns_cache.get(key)
+    if cached is None or cached[0] is not indices:
+        cached = bone_patterns_cache[key] = (indices, {})
+    names = cached[1].get((mode, pattern))
+    if names is None:
+        match = bone_pattern(mode, pattern)
+        names = cached[1][(mode, pattern)] = [name for name in indices if match(name)]
+    return names
+
+def bone_names_collection(obj, names):
+    """Finds the bones in bone collections, or bone groups before Blender 4.0, by name.
+    Returns: List of bone names.
+    """
+    arma = obj.data
+    collections = getattr(arma, 'collections_all', None) or getattr(arma, 'collections', None)
+    if collections is None:
+        bones = [
+            bone.name for bone in obj.pose.bones
+            if bone.bone_group and bone.bone_group.name in names
+        ]
+    else:
+        bones = []
+        for name in names:
+            if name in collections:
+                bones.extend(bone.name for bone in collections[name].bones)
+    return list(dict.fromkeys(bones))
+
+def fcurves_insert(action, data_path, frames, values, group=''):
+    """Inserts keyframes for every array index of a property, one batch per F-Curve.
+    Missing F-Curves are created, keyframes already sitting on one of the frames
+    get their values (and handles) replaced, all others are allocated at once.
+    values is a list of value lists, one per array index, matching frames.
+    Returns: None.
+    """
+    for index, channel in enumerate(values):
+        fc = action.fcurves.find(data_path, index=index)
+        if not fc:
+            fc = action.fcurves.new(data_path, index=index, action_group=group)
+        count = len(fc.keyframe_points)
+        co = array.array('f', [0.0]) * (count * 2)
+        fc.keyframe_points.foreach_get('co', co)
+        existing = {co[i * 2]: i for i in range(count)}
+        handles = None
+        added = array.array('f')
+        for f, value in zip(frames, channel):
+            i = existing.get(f)
+            if i is None:
+                added.extend((f, value))
+                continue
+            if handles is None:
+                handles = {}
+                for side in ('handle_left', 'handle_right'):
+                    handles[side] = array.array('f', [0.0]) * (count * 2)
+                    fc.keyframe_points.foreach_get(side, handles[side])
+            delta = value - co[i * 2 + 1]
+            co[i * 2 + 1] = value
+            for side in handles:
+                handles[side][i * 2 + 1] += delta
+        if handles:
+            for side in handles:
+                fc.keyframe_points.foreach_set(side, handles[side])
+        if added:
+            fc.keyframe_points.add(len(added) // 2)
+            co.extend(added)
+        fc.keyframe_points.foreach_set('co', co)
+        fc.update()
+    action_indices.pop(action.as_pointer(), None)
+
+def fcurves_bake(obj, frames, matrices, group='Object Transforms'):
+    """Bakes a batch of world matrices into a new action on an object without parent.
+    Instead of inserting keyframes frame by frame, all matrices are decomposed at once
+    and every F-Curve gets its keyframe points allocated and filled in one go.
+    Returns: Action.
+    """
+    if not obj.animation_data:
+        obj.animation_data_create()
+    action = bpy.data.actions.new(obj.name + 'Action')
+    obj.animation_data.action = action
+    channels = bmat.matrices_channels(matrices, obj.rotation_mode)
+    for data_path in channels:
+        fcurves_insert(action, data_path, frames, channels[data_path], group)
+    return action
+
+transform_clipboard = {
+    'frames': array.array('f'),
+    'targets': {},
+    'matrices': array.array('d')
+}
+
+def transform_clipboard_set(targets, frames, matrices):
+    """Stores world matrices of (object name, bone name) targets for a list of frames
+    in one contiguous array of floats, target by target.
+    matrices is a list of batches, one per target, matching frames.
+    Returns: None.
+    """
+    flat = array.array('d')
+    for batch in matrices:
+        flat.extend(bmat.matrices_flat(batch))
+    transform_clipboard['frames'] = array.array('f', frames)
+    transform_clipboard['targets'] = {t: i for i, t in enumerate(targets)}
+    transform_clipboard['matrices'] = flat
+
+def transform_clipboard_target(obj, bone=None, single=False):
+    """Finds the stored target for an object or pose bone, matching by object and bone name
+    or by bone name only. With single, a lone stored target matches anything.
+    Returns: Integer, None if nothing matches.
+    """
+    targets = transform_clipboard['targets']
+    bone_name = bone.name if bone else ''
+    if (obj.name, bone_name) in targets:
+        return targets[(obj.name, bone_name)]
+    if bone:
+        for (obj_name, name), i in targets.items():
+            if name == bone_name:
+                return i
+    if single and len(targets) == 1:
+        return 0
+    return None
+
+def transform_clipboard_matrices(target=0):
+    """Looks up the stored world matrices of a target for all stored frames.
+    Returns: List of matrices.
+    """
+    size = len(transform_clipboard['frames']) * 16
+    t = transform_clipboard['matrices'][target * size:(target + 1) * size]
+    return bmat.matrices_list(bmat.matrices_from_flat(t))
+
+def transform_chain(obj, bone=None):
+    """Collects everything needed to compute the world matrix of an object or pose bone
+    straight from its F-Curves and the ones of its parents, without evaluating the scene.
+    Returns: List of links from root to tip, None if constraints, drivers, NLA
+    or unsupported parenting require a full scene evaluation.
+    """
+    transform_props = (
+        'location',
+        'rotation_euler',
+        'rotation_quaternion',
+        'rotation_axis_angle',
+        'scale'
+    )
+    delta_props = (
+        'delta_location',
+        'delta_rotation_euler',
+        'delta_rotation_quaternion',
+        'delta_scale'
+    )
+
+    def animation_check(anim_data, prefixes):
+        if not anim_data:
+            return True
+        if anim_data.use_tweak_mode:
+            return False
+        if getattr(anim_data, 'action_influence', 1.0) != 1.0:
+            return False
+        if getattr(anim_data, 'action_blend_type', 'REPLACE') != 'REPLACE':
+            return False
+        for track in anim_data.nla_tracks:
+            if not track.mute:
+                return False
+        for driver in anim_data.drivers:
+            if driver.data_path.startswith(prefixes):
+                return False
+        return True
+
+    def channels(struct, action, prefix, props):
+        channels = {}
+        for prop in props:
+            channel = []
+            for index, value in enumerate(getattr(struct, prop)):
+                fc = action.fcurves.find(prefix + prop, index=index) if action else None
+                channel.append((fc, value))
+            channels[prop] = channel
+        return channels
+
+    chain = []
+
+    # Bones
+    if bone:
+        if obj.data.pose_position == 'REST':
+            return None
+        bones = [bone] + list(bone.parent_recursive)
+        for pb in obj.pose.bones:
+            for con in pb.constraints:
+                if con.type in ('IK', 'SPLINE_IK'):
+                    affected = [pb] + list(pb.parent_recursive)
+                    if con.chain_count:
+                        affected = affected[:con.chain_count + 1]
+                    if any(b in bones for b in affected):
+                        return None
+        anim_data = obj.animation_data
+        action = anim_data.action if anim_data else None
+        prefixes = tuple('pose.bones["' + b.name + '"]' for b in bones)
+        if not animation_check(anim_data, prefixes):
+            return None
+        rest = rest_matrices(obj.data)
+        for b in reversed(bones):
+            if b.constraints:
+                return None
+            bone_channels = channels(b, action, 'pose.bones["' + b.name + '"].', transform_props)
+            # Connected bones ignore their location
+            if b.bone.use_connect:
+                bone_channels['location'] = [(None, 0.0)] * 3
+            chain.append({
+                'bone': b.bone,
+                'inherit': (
+                    b.bone.use_inherit_rotation
+                    and getattr(b.bone, 'inherit_scale', 'FULL') == 'FULL'
+                    and b.bone.use_local_location
+                    and not b.bone.use_connect
+                ),
+                'matrix_local': rest[b.name][0],
+                'parent_matrix_local': rest[b.parent.name][0] if b.parent else None,
+                'rotation_mode': b.rotation_mode,
+                'channels': bone_channels
+            })
+
+    # Objects
+    parent = obj
+    while parent:
+        if parent.constraints or parent.rigid_body:
+            return None
+        if parent.parent and parent.parent_type != 'OBJECT':
+            return None
+        anim_data = parent.animation_data
+        action = anim_data.action if anim_data else None
+        if not animation_check(anim_data, transform_props + delta_props):
+            return None
+        chain.insert(0, {
+            'object': parent,
+            # Without a parent, the parent inverse is ignored
+            'matrix_parent_inverse': parent.matrix_parent_inverse.copy() if parent.parent else None,
+            'rotation_mode': parent.rotation_mode,
+            'channels': channels(parent, action, '', transform_props + delta_props)
+        })
+        parent = parent.parent
+
+    return chain
+
+def transform_chain_matrices(chain, frames):
+    """Composes the world matrices for a list of frames at once from a chain
+    collected by transform_chain.
+    Returns: Batch of matrices.
+    """
+    count = len(frames)
+    if not count:
+        return bmat.matrices_new([])
+
+    def values(channel):
+        # Rows of per frame values
+        columns = []
+        for fc, value in channel:
+            if fc:
+                columns.append([fc.evaluate(f) for f in frames])
+            else:
+                columns.append([value] * count)
+        return list(zip(*columns))
+
+    def rotation(channels, rotation_mode, delta=False):
+        d = 'delta_' if delta else ''
+        if rotation_mode == 'QUATERNION':
+            return bmat.rotations_to_matrices(values(channels[d + 'rotation_quaternion']), rotation_mode)
+        elif rotation_mode == 'AXIS_ANGLE':
+            if delta:
+                return bmat.rotations_to_matrices([(0.0, 0.0, 0.0)] * count)
+            return bmat.rotations_to_matrices(values(channels['rotation_axis_angle']), rotation_mode)
+        else:
+            return bmat.rotations_to_matrices(values(channels[d + 'rotation_euler']), rotation_mode)
+
+    matrix = bmat.matrices_new([mathutils.Matrix()])
+    pose = None
+    for link in chain:
+        ch = link['channels']
+        rot = rotation(ch, link['rotation_mode'])
+
+        # Bone
+        if 'bone' in link:
+            basis = bmat.matrices_compose(values(ch['location']), rot, values(ch['scale']))
+            if link['inherit']:
+                if link['parent_matrix_local']:
+                    offset = link['parent_matrix_local'].inverted() @ link['matrix_local']
+                    offset = bmat.matrices_multiply(pose, bmat.matrices_new([offset]))
+                else:
+                    offset = bmat.matrices_new([link['matrix_local']])
+                pose = bmat.matrices_multiply(offset, basis)
+            else:
+                bone = link['bone']
+                poses = []
+                for i, m in enumerate(bmat.matrices_list(basis)):
+                    if link['parent_matrix_local']:
+                        poses.append(bone.convert_local_to_pose(
+                            m,
+                            link['matrix_local'],
+                            parent_matrix=mathutils.Matrix(pose[i]),
+                            parent_matrix_local=link['parent_matrix_local']
+                        ))
+                    else:
+                        poses.append(bone.convert_local_to_pose(m, link['matrix_local']))
+                pose = bmat.matrices_new(poses)
+
+        # Object
+        else:
+            loc = [[a + b for a, b in zip(l, d)] for l, d in zip(values(ch['location']), values(ch['delta_location']))]
+            rot = bmat.matrices_multiply(rotation(ch, link['rotation_mode'], delta=True), rot)
+            sca = [[a * b for a, b in zip(s, d)] for s, d in zip(values(ch['scale']), values(ch['delta_scale']))]
+            basis = bmat.matrices_compose(loc, rot, sca)
+            if link['matrix_parent_inverse'] is not None:
+                matrix = bmat.matrices_multiply(matrix, bmat.matrices_new([link['matrix_parent_inverse']]))
+            matrix = bmat.matrices_multiply(matrix, basis)
+
+    if pose is not None:
+        return bmat.matrices_multiply(matrix, pose)
+    return matrix
+
+def transform_sample(context, targets, evaluation='CHAIN'):
+    """Samples world matrices for a list of (object, pose bone or None, frames) targets.
+    The 'CHAIN' evaluation only computes what each target depends on. All other targets
+    share a single sweep over the union of their frames, setting each frame on the scene once.
+    Returns: List of batches, one per target.
+    """
+    results = [None] * len(targets)
+    swept = []
+    sweep = {}
+    for i, (obj, bone, frames) in enumerate(targets):
+        chain = transform_chain(obj, bone) if evaluation == 'CHAIN' else None
+        if chain:
+            results[i] = transform_chain_matrices(chain, frames)
+        else:
+            results[i] = [None] * len(frames)
+            swept.append(i)
+            for j, f in enumerate(frames):
+                sweep.setdefault(f, []).append((i, j))
+
+    if sweep:
+        scene = context.scene
+        frame_current = scene.frame_current
+        for f in sorted(sweep):
+            scene.frame_set(int(f), subframe=f - int(f))
+            for i, j in sweep[f]:
+                obj, bone = targets[i][:2]
+                if bone:
+                    results[i][j] = obj.matrix_world @ bone.matrix
+                else:
+                    results[i][j] = obj.matrix_world.copy()
+        scene.frame_set(frame_current)
+    for i in swept:
+        results[i] = bmat.matrices_new(results[i])
+    return results
+
+def transform_trail(context, name, frames, matrices, obj, bone=None):
+    """Creates a trail from a batch of matrices as a single mesh object with one vertex
+    per frame, connected by edges. Frames and matrix axes are stored as point attributes.
+    Returns: Object.
+    """
+    flat = bmat.matrices_flat(matrices)
+    count = len(frames)
+    mesh = bpy.data.meshes.new('TRF-' + name)
+    mesh.from_pydata(
+        [(flat[i + 3], flat[i + 7], flat[i + 11]) for i in range(0, count * 16, 16)],
+        [(i, i + 1) for i in range(count - 1)],
+        []
+    )
+    attribute = mesh.attributes.new('blatools_frame', 'FLOAT', 'POINT')
+    attribute.data.foreach_set('value', frames)
+    for axis in range(3):
+        attribute = mesh.attributes.new('blatools_axis_' + 'xyz'[axis], 'FLOAT_VECTOR', 'POINT')
+        vectors = []
+        for i in range(axis, count * 16, 16):
+            vectors.extend((flat[i], flat[i + 4], flat[i + 8]))
+        attribute.data.foreach_set('vector', vectors)
+    mesh.update()
+
+    trail = bpy.data.objects.new('TRF-' + name, mesh)
+    context.scene.collection.objects.link(trail)
+    trail.display_type = 'WIRE'
+    trail.show_in_front = True
+    trail["blatools_transform"] = 1
+    trail["blatools_transform_object"] = obj.name
+    trail["blatools_transform_bone"] = bone.name if bone else ""
+    return trail
 
 #########################
 ## TRAIL IN COLLECTION ##
@@ -65,121 +713,156 @@ def transform_store(
             keyframes=False,
             range_min=1,
             range_max=250,
-            trail=False
+            trail=False,
+            evaluation='CHAIN',
+            trail_mode='MESH',
+            selected=False
         ):
     blatools = context.window_manager.blatools
     scene = context.scene
-    obj = context.active_object
-    name = obj.name
+
+    # Targets
+    targets = []
     if context.mode == 'POSE' and context.active_pose_bone:
-        name += "_" + context.active_pose_bone.name
+        targets.append((context.active_object, context.active_pose_bone))
+        if selected:
+            for b in context.selected_pose_bones:
+                if b != context.active_pose_bone:
+                    targets.append((b.id_data, b))
+    else:
+        targets.append((context.active_object, None))
+        if selected:
+            for obj in context.selected_objects:
+                if obj != context.active_object:
+                    targets.append((obj, None))
+
+    def name(obj, bone):
+        if bone:
+            return obj.name + "_" + bone.name
+        else:
+            return obj.name
 
-    def matrix(context):
-        obj = context.active_object
+    def matrix(obj, bone):
         matrix_obj = mathutils.Matrix(obj.matrix_world)
-        if context.mode == 'POSE' and context.active_pose_bone:
-            return matrix_obj @ context.active_pose_bone.matrix
+        if bone:
+            return matrix_obj @ bone.matrix
         else:
             return matrix_obj
 
-    def fcurve_check(context, fcurve):
-        obj = context.active_object
-        if context.mode == 'POSE' and context.active_pose_bone:
-            b = 'pose.bones["' + context.active_pose_bone.name + '"].'
-            data_paths = (
-                b + 'location',
-                b + 'rotation_euler',
-                b + 'rotation_quaternion',
-                b + 'rotation_euler',
-                b + 'rotation_axis_angle',
-                b + 'scale'
-            )
-        else:
-            data_paths = (
-                'location',
-                'rotation_euler',
-                'scale'
-            )
-        return fcurve.data_path.endswith(data_paths)
-    
-    def empty(context, matrix, name, size=0.1):
+    def empty(context, matrix, name, obj, bone, frame=None, size=0.1):
         empty = bpy.data.objects.new('TRF-' + name, None)
         context.scene.collection.objects.link(empty)
         empty.matrix_world = matrix
         empty.empty_display_size = size
         empty["blatools_transform"] = 1
-        empty["blatools_transform_object"] = context.active_object.name
-        empty["blatools_transform_bone"] = context.active_pose_bone.name
-        empty["blatools_transform_frame"] = context.scene.frame_current
+        empty["blatools_transform_object"] = obj.name
+        empty["blatools_transform_bone"] = bone.name if bone else ""
+        empty["blatools_transform_frame"] = context.scene.frame_current if frame is None else frame
         return empty
 
     # Copy
     if target == 'STORE':
         index = 0
-        for v in matrix(context):
+        for v in matrix(*targets[0]):
             for f in v:
                 blatools.transform_tmp[index] = f
                 index += 1
 
+        # Frame range clipboard, all targets share the union of their keyframes
+        names = [(obj.name, bone.name if bone else '') for obj, bone in targets]
+        if keyframes:
+            keys = set()
+            for obj, bone in targets:
+                if hasattr(obj.animation_data, 'action') and obj.animation_data.action:
+                    action = obj.animation_data.action
+                    keys.update(action_keys(action, bone.name if bone else '', range_min, range_max))
+            keys = sorted(keys)
+            samples = transform_sample(context, [(obj, bone, keys) for obj, bone in targets], evaluation)
+            transform_clipboard_set(names, keys, samples)
+        else:
+            transform_clipboard_set(names, [scene.frame_current], [bmat.matrices_new([matrix(obj, bone)]) for obj, bone in targets])
+
     # Cursor
     if target == 'CURSOR':
-        scene.cursor.matrix = matrix(context)
+        scene.cursor.matrix = matrix(*targets[0])
     
     # Empty
     elif target == 'EMPTY':
 
         # Keyframes
-        keys = []
-        if keyframes and hasattr(obj.animation_data, 'action') and obj.animation_data.action:
-            action = obj.animation_data.action
-            keys = []
-            for fc in action.fcurves:
-                if fcurve_check(context, fc):
-                    for kp in fc.keyframe_points:
-                        f = int(kp.co[0])
-                        if f <= range_max and f >= range_min and f not in keys:
-                            keys.append(kp.co[0])
-
-            # Trail
-            if trail:
-                frame_current = scene.frame_current
-                for f in keys:
-                    scene.frame_set(f)
-                    name_f = name + "_f" + str(int(f)).zfill(4)
-                    empty(context, matrix(context), name_f)
-                scene.frame_set(frame_current)
-
-            # No Trail
+        sample = []
+        bake = []
+        for obj, bone in targets:
+            if keyframes and hasattr(obj.animation_data, 'action') and obj.animation_data.action:
+                action = obj.animation_data.action
+                keys = action_keys(action, bone.name if bone else '', range_min, range_max)
+
+                # Trail
+                if trail:
+                    sample.append((obj, bone, keys))
+
+                # No Trail
+                else:
+                    bake_empty = empty(context, matrix(obj, bone), name(obj, bone), obj, bone)
+                    if len(keys) > 1:
+                        sample.append((obj, bone, keys))
+                        bake.append(bake_empty)
+
+            # Simple empty
             else:
-                empty = empty(context, matrix(context), name)
-
-                # Keyframes Action
-                if len(keys) > 1:
-                    group = 'Object Transforms'
-                    frame_current = scene.frame_current
-                    for f in keys:
-                        scene.frame_set(f)
-                        empty.matrix_world = matrix(context)
-                        empty.keyframe_insert('location', frame=f, group=group)
-                        empty.keyframe_insert('rotation_euler', frame=f, group=group)
-                        empty.keyframe_insert('scale', frame=f, group=group)
-                    scene.frame_set(frame_current)
-            
-        # Simple empty
+                empty(context, matrix(obj, bone), name(obj, bone), obj, bone)
+
+        # One sweep for all targets
+        samples = transform_sample(context, sample, evaluation)
+
+        # Trail
+        if trail:
+            for (obj, bone, keys), matrices in zip(sample, samples):
+                if trail_mode == 'MESH':
+                    if keys:
+                        transform_trail(context, name(obj, bone) + "_trail", keys, matrices, obj, bone)
+                else:
+                    for f, m in zip(keys, bmat.matrices_list(matrices)):
+                        name_f = name(obj, bone) + "_f" + str(int(f)).zfill(4)
+                        empty(context, m, name_f, obj, bone, int(f))
+
+        # Keyframes Action
         else:
-            empty(context, matrix(context), name)
+            for bake_empty, (obj, bone, keys), matrices in zip(bake, sample, samples):
+                fcurves_bake(bake_empty, keys, matrices)
 
-#####################################################
-## OBJECT CONSTRAINTS? SELEKTOR, MULTI FRAME APPLY ##
-#####################################################
+###################################
+## OBJECT CONSTRAINTS? SELEKTOR ##
+###################################
 
-def transform_paste(context, source):
+def transform_paste(context, source, frames='CURRENT', range_min=1, range_max=250):
     blatools = context.window_manager.blatools
 
-    def apply(context, m):
-        obj = context.active_object
-        if context.mode == 'POSE' and context.active_pose_bone:
-            b = context.active_pose_bone
+    # Pastes armature space matrices onto pose bones of one armature, parents before children.
+    # Parent matrices are shared across siblings, children follow their pasted parents.
+    def solve(obj, bones, matrices):
+        rest = rest_matrices(obj.data)
+        parents = {}
+        poses = {}
+
+        def pose_new(b):
+            # New pose matrix of a bone moved by pasted parents, None if unaffected
+            if b.name not in poses:
+                poses[b.name] = None
+                if b.parent:
+                    parent = pose_new(b.parent)
+                    if parent is not None:
+                        poses[b.name] = b.bone.convert_local_to_pose(
+                            b.matrix_basis,
+                            rest[b.name][0],
+                            parent_matrix=parent,
+                            parent_matrix_local=rest[b.parent.name][0]
+                        )
+            return poses[b.name]
+
+        order = sorted(range(len(bones)), key=lambda i: len(bones[i].parent_recursive))
+        for i in order:
+            b = bones[i]
 
             #######################################################
             ## To properly calculate the necessary transforms,   ##
@@ -187,37 +870,45 @@ def transform_paste(context, source):
             ## by constraints and then add the difference only.  ##
             #######################################################
 
-            # Object matrix
-            matrix_obj = mathutils.Matrix(obj.matrix_world)
-            
             # Parent bone matrix
             if b.parent:
-                matrix_parent_loc = mathutils.Matrix(b.parent.bone.matrix_local)
-                matrix_parent_abs = mathutils.Matrix(b.parent.matrix)
-                matrix_parent = matrix_parent_abs @ matrix_parent_loc.inverted()
+                if b.parent.name not in parents:
+                    parents[b.parent.name] = b.parent.matrix @ rest[b.parent.name][1]
+                matrix_parent = parents[b.parent.name]
             else:
                 matrix_parent = mathutils.Matrix()
 
-            # Bone rest matrix
-            matrix_loc = mathutils.Matrix(b.bone.matrix_local)
-            matrix_loc.resize_4x4()
-
-            # Current absolute pose transform matrix
-            matrix = mathutils.Matrix(b.matrix)
-
-            # Local bone transforms
-            matrix_basis = mathutils.Matrix(b.matrix_basis)
-
             # Calculate ONLY transforms (+ parenting) in world
-            matrix_transforms = matrix_loc @ matrix_basis
+            matrix_transforms = rest[b.name][0] @ b.matrix_basis
 
-            # Calculate ONLY constraints matrix
-            matrix_constraints = matrix @ matrix_transforms.inverted() @ matrix_parent.inverted()
+            # Calculate ONLY constraints matrix, inverted right away:
+            # (matrix @ transforms⁻¹ @ parent⁻¹)⁻¹ = parent @ transforms @ matrix⁻¹
+            matrix_constraints_inv = matrix_parent @ matrix_transforms @ b.matrix.inverted()
 
             # Apply all matrices for new transforms
-            b.matrix = matrix_constraints.inverted() @ matrix_obj.inverted() @ m
+            pose = matrix_constraints_inv @ matrices[i]
+            parent = pose_new(b.parent) if b.parent else None
+            if parent is None:
+                b.matrix = pose
+            else:
+                b.matrix_basis = b.bone.convert_local_to_pose(
+                    pose,
+                    rest[b.name][0],
+                    parent_matrix=parent,
+                    parent_matrix_local=rest[b.parent.name][0],
+                    invert=True
+                )
+            poses[b.name] = pose
 
-        else:
+    # Pastes (object, pose bone or None, matrix) targets on the current frame
+    def apply(context, targets):
+        bones = {}
+        for obj, b, m in targets:
+            if b:
+                bones.setdefault(obj, ([], []))
+                bones[obj][0].append(b)
+                bones[obj][1].append(m)
+                continue
             ### NOT WORKING YET
             '''
             if obj.parent:
@@ -254,190 +945,1151 @@ def transform_paste(context, source):
             obj.matrix_basis = m @ matrix_pre.inverted() @ matrix_parent_inverse
             '''
             obj.matrix_world = m
+        for obj, (bs, matrices) in bones.items():
+            matrix_obj_inv = obj.matrix_world.inverted()
+            solve(obj, bs, [matrix_obj_inv @ m for m in matrices])
+
+    # Pastes and keys (object, pose bone or None, matrices) targets on a list of frames
+    def apply_frames(context, frames, targets):
+        scene = context.scene
+        bones = {}
+        keying = []
+        for obj, b, matrices in targets:
+            if b:
+                bones.setdefault(obj, ([], []))
+                bones[obj][0].append(b)
+                bones[obj][1].append(matrices)
+                prefix = 'pose.bones["' + b.name + '"].'
+                group = b.name
+            else:
+                b = obj
+                prefix = ''
+                group = 'Object Transforms'
+            if b.rotation_mode == 'QUATERNION':
+                props = ('location', 'rotation_quaternion', 'scale')
+            elif b.rotation_mode == 'AXIS_ANGLE':
+                props = ('location', 'rotation_axis_angle', 'scale')
+            else:
+                props = ('location', 'rotation_euler', 'scale')
+            values = {prop: [[] for v in getattr(b, prop)] for prop in props}
+            keying.append((obj, b, prefix, group, values))
 
+        # Armatures computable from their F-Curves get their world matrices inverted for all
+        # frames at once, targets are moved into armature space before sweeping the frames
+        local = set()
+        for obj, (bs, matrices) in bones.items():
+            chain = transform_chain(obj)
+            if chain:
+                inverses = bmat.matrices_invert(transform_chain_matrices(chain, frames))
+                bones[obj] = (bs, [
+                    bmat.matrices_list(bmat.matrices_multiply(inverses, bmat.matrices_new(m)))
+                    for m in matrices
+                ])
+                local.add(obj)
+
+        # One evaluation per frame, values are collected for keying
+        frame_current = scene.frame_current
+        for i, f in enumerate(frames):
+            scene.frame_set(int(f), subframe=f - int(f))
+            for obj, b, matrices in targets:
+                if not b:
+                    obj.matrix_world = matrices[i]
+            for obj, (bs, matrices) in bones.items():
+                if obj in local:
+                    solve(obj, bs, [m[i] for m in matrices])
+                else:
+                    matrix_obj_inv = obj.matrix_world.inverted()
+                    solve(obj, bs, [matrix_obj_inv @ m[i] for m in matrices])
+            for obj, b, prefix, group, values in keying:
+                for prop in values:
+                    for index, v in enumerate(getattr(b, prop)):
+                        values[prop][index].append(v)
+
+        # Keyframes
+        for obj, b, prefix, group, values in keying:
+            if not obj.animation_data:
+                obj.animation_data_create()
+            if not obj.animation_data.action:
+                obj.animation_data.action = bpy.data.actions.new(obj.name + 'Action')
+            for prop in values:
+                fcurves_insert(obj.animation_data.action, prefix + prop, frames, values[prop], group)
+        scene.frame_set(frame_current)
+
+    obj = context.active_object
+    b = context.active_pose_bone if context.mode == 'POSE' else None
+
+    def apply_range(context, m):
+        if frames == 'RANGE':
+            keys = [float(f) for f in range(range_min, range_max + 1)]
+        else:
+            keys = []
+            if obj.animation_data and obj.animation_data.action:
+                keys = action_keys(obj.animation_data.action, b.name if b else '', range_min, range_max)
+        if keys:
+            apply_frames(context, keys, [(obj, b, [m] * len(keys))])
 
     # Store
     if source == 'STORE':
-        m = mathutils.Matrix()
-        t = blatools.transform_tmp
-        c = 0
-        while c < 16:
-            col = int(c / 4)
-            row = int(c % 4)
-            m[col][row] = t[c]
-            c += 1
-        apply(context, m)
+        m = bmat.matrices_list(bmat.matrices_from_flat(blatools.transform_tmp))[0]
+        if frames == 'CURRENT':
+            apply(context, [(obj, b, m)])
+        else:
+            apply_range(context, m)
 
     # Cursor
     elif source == 'CURSOR':
-        apply(context, context.scene.cursor.matrix) 
+        if frames == 'CURRENT':
+            apply(context, [(obj, b, context.scene.cursor.matrix.copy())])
+        else:
+            apply_range(context, context.scene.cursor.matrix.copy())
 
-def selection_sets_select(context, position, select=True, clear=False):
+    # Frame range clipboard, every selected bone or object gets its own stored matrices.
+    # On the current frame, its stored frame or the only stored frame is pasted without keying.
+    elif source == 'CLIPBOARD':
+        keys = list(transform_clipboard['frames'])
+        if context.mode == 'POSE' and context.active_pose_bone:
+            candidates = [(b.id_data, b) for b in context.selected_pose_bones]
+            if context.active_pose_bone not in context.selected_pose_bones:
+                candidates.insert(0, (context.active_object, context.active_pose_bone))
+        else:
+            candidates = [(obj, None) for obj in context.selected_objects]
+            if context.active_object not in context.selected_objects:
+                candidates.insert(0, (context.active_object, None))
+        targets = []
+        for obj, b in candidates:
+            i = transform_clipboard_target(obj, b, single=len(candidates) == 1)
+            if i is not None:
+                targets.append((obj, b, transform_clipboard_matrices(i)))
+        if not keys or not targets:
+            return
+        if frames == 'CURRENT':
+            current = float(context.scene.frame_current)
+            if current in keys:
+                j = keys.index(current)
+            elif len(keys) == 1:
+                j = 0
+            else:
+                return
+            apply(context, [(t_obj, t_b, matrices[j]) for t_obj, t_b, matrices in targets])
+        else:
+            apply_frames(context, keys, targets)
+
+selection_sets_indices = {}
+selection_sets_versions = {}
+selection_sets_models = {}
+
+def selection_sets_changed(scene, names=True):
+    """Bumps the selection sets version of a scene so cached draw data is rebuilt.
+    Also drops the name index, unless names and positions are known to be unchanged.
+    Returns: None.
+    """
+    key = scene.as_pointer()
+    if names:
+        selection_sets_indices.pop(key, None)
+    selection_sets_versions[key] = selection_sets_versions.get(key, 0) + 1
+
+def selection_sets_model(scene):
+    """Gets the cached draw model of the selection sets of a scene, rebuilt only
+    when the version of the sets changed.
+    Returns: Dictionary with 'rows' as list of (name, icon) and cached 'filters'.
+    """
+    key = scene.as_pointer()
+    version = selection_sets_versions.get(key, 0)
+    sets = scene.blatools.selection_sets
+    model = selection_sets_models.get(key)
+    if model is None or model['version'] != version or len(model['rows']) != len(sets):
+        model = selection_sets_models[key] = {
+            'version': version,
+            'rows': [(s.name, s.icon) for s in sets],
+            'filters': {}
+        }
+    return model
+
+def selection_sets_filter(scene, bitflag, pattern='', invert=False, sort_alpha=False):
+    """Filters and sorts the selection sets of a scene by name for UI lists, cached
+    per filter settings until the sets change.
+    Returns: Tuple of flags and order lists.
+    """
+    model = selection_sets_model(scene)
+    key = (bitflag, pattern, invert, sort_alpha)
+    if key not in model['filters']:
+        names = [row[0] for row in model['rows']]
+        if pattern:
+            regex = re.compile(fnmatch.translate("*" + pattern + "*"), re.IGNORECASE)
+            flags = [bitflag if bool(regex.match(name)) is not invert else 0 for name in names]
+        else:
+            flags = [bitflag] * len(names)
+        order = []
+        if sort_alpha:
+            order = [0] * len(names)
+            for i, position in enumerate(sorted(range(len(names)), key=lambda p: names[p].lower())):
+                order[position] = i
+        model['filters'][key] = (flags, order)
+    return model['filters'][key]
+
+def selection_sets_index(scene, name):
+    """Finds the position of a selection set by name, using a cached name index per scene.
+    Returns: Integer or None.
+    """
+    sets = scene.blatools.selection_sets
+    key = scene.as_pointer()
+    index = selection_sets_indices.get(key)
+    if index is None or len(index) != len(sets):
+        index = selection_sets_indices[key] = {s.name: i for i, s in enumerate(sets)}
+    position = index.get(name)
+    if position is not None and sets[position].name != name:
+        index = selection_sets_indices[key] = {s.name: i for i, s in enumerate(sets)}
+        position = index.get(name)
+    return position
+
+@bpy.app.handlers.persistent
+def selection_sets_migrate(*args):
+    """Moves selection sets from the legacy scene dictionary into the typed collection.
+    Returns: None.
+    """
+    for scene in bpy.data.scenes:
+        if 'blatools_selection_sets' not in scene:
+            continue
+        legacy = scene['blatools_selection_sets']
+        sets = scene.blatools.selection_sets
+        for name in sorted(legacy.keys(), key=lambda n: legacy[n].get('position', 0)):
+            if selection_sets_index(scene, name) is not None:
+                continue
+            data = legacy[name]
+            sel_set = sets.add()
+            sel_set.name = name
+            sel_set.icon = data.get('icon', 'BLANK1')
+            sel_set.source = data.get('source', '')
+            for bone in data.get('bones', []):
+                set_bone = sel_set.bones.add()
+                set_bone.name = bone['name']
+                set_bone.active = bool(bone.get('active', False))
+        del scene['blatools_selection_sets']
+        selection_sets_changed(scene)
+
+def posemode_add(context, obj):
+    """Adds an armature to the current pose mode session next to the objects already
+    in it, without leaving pose mode. The active object stays the same.
+    Returns: Boolean, whether the armature is in pose mode.
+    """
+    view_layer = context.view_layer
+    if obj.mode == 'POSE':
+        return True
+    if obj.type != 'ARMATURE' or obj.name not in view_layer.objects:
+        return False
+    active = view_layer.objects.active
+    obj.select_set(state=True)
+    view_layer.objects.active = obj
+    try:
+        bpy.ops.object.posemode_toggle()
+    finally:
+        view_layer.objects.active = active
+    return obj.mode == 'POSE'
+
+def selection_set_bones(sel_set, obj):
+    """Resolves the bones of a selection set on an armature object. Static sets list
+    their stored bones, dynamic sets only ever resolve to existing bones.
+    Returns: Tuple of bone names list and active bone name or None.
+    """
+    if sel_set.mode == 'STATIC':
+        names = []
+        active_name = None
+        for bone in sel_set.bones:
+            names.append(bone.name)
+            if bone.active:
+                active_name = bone.name
+        return names, active_name
+    if sel_set.mode == 'COLLECTION':
+        names = [name.strip() for name in sel_set.pattern.split(',') if name.strip()]
+        return bone_names_collection(obj, names), None
+    try:
+        return bone_names_match(obj.data, sel_set.mode, sel_set.pattern), None
+    except re.error:
+        return [], None
+
+def selection_sets_rigs(context, sources):
+    """Gets the rigs selection sets are applied to, following the rig filter. Source rigs
+    of the given names are added to pose mode if needed.
+    Returns: List of armature objects.
+    """
     blatools = context.window_manager.blatools
-    missing_list = []
-    set_used = None
-    for sel_set in context.scene['blatools_selection_sets']:
-        if context.scene['blatools_selection_sets'][sel_set]['position'] == position:
-            set_used = context.scene['blatools_selection_sets'][sel_set]
-            break
-    if clear:
-        bpy.ops.pose.select_all(action='DESELECT')
     if blatools.selection_sets_filter_rig == 'ALL':
-        armatures = []
+        rigs = []
         for obj in context.selected_objects:
             if obj.type == 'ARMATURE':
-                armatures.append(obj.data)
+                rigs.append(obj)
     elif blatools.selection_sets_filter_rig == 'ACTIVE':
-        armatures = [bpy.context.active_object.data]
+        rigs = [bpy.context.active_object]
     elif blatools.selection_sets_filter_rig == 'SOURCE':
-        if set_used and 'source' in set_used and set_used['source'] in context.scene.objects:
-            obj = bpy.data.objects[set_used['source']]
-            if obj not in context.selected_objects and context.mode == 'POSE':
-                bpy.ops.object.mode_set(mode='OBJECT')
-                obj.select_set(state=True)
-                bpy.ops.object.mode_set(mode='POSE')
-            armatures = [obj.data]
+        rigs = []
+        for source in dict.fromkeys(sources):
+            if source in context.scene.objects:
+                obj = bpy.data.objects[source]
+                if obj.mode != 'POSE' and context.mode == 'POSE':
+                    posemode_add(context, obj)
+                rigs.append(obj)
+        if not rigs:
+            rigs = [bpy.context.active_object]
+    else:
+        rigs = [bpy.data.objects[blatools.selection_sets_filter_rig]]
+    return rigs
+
+def bones_select(armature, names, select=True, clear=False, active_name=None):
+    """Selects or deselects bones of an armature in one bulk write.
+    Returns: None.
+    """
+    indices = bone_indices(armature)
+    flags = [False] * len(armature.bones)
+    if not clear:
+        armature.bones.foreach_get('select', flags)
+    for name in names:
+        flags[indices[name]] = select
+    armature.bones.foreach_set('select', flags)
+    armature.update_tag()
+    if active_name in indices:
+        armature.bones.active = armature.bones[indices[active_name]]
+
+def selection_sets_select(context, position, select=True, clear=False):
+    blatools = context.window_manager.blatools
+    sets = context.scene.blatools.selection_sets
+    missing_list = []
+    set_used = sets[position] if 0 <= position < len(sets) else None
+    if clear:
+        bpy.ops.pose.select_all(action='DESELECT')
+    rigs = selection_sets_rigs(context, [set_used.source] if set_used else [])
+
+    if not set_used:
+        return [None, missing_list]
+    for obj in rigs:
+        arma = obj.data
+        names, active_name = selection_set_bones(set_used, obj)
+        missing = set(names).difference(bone_indices(arma))
+        if not select or blatools.selection_sets_make_active != 'SET':
+            active_name = None
+        bones_select(arma, [name for name in names if name not in missing], select, active_name=active_name)
+        missing_list.extend(arma.name + ": " + name for name in names if name in missing)
+    ui_redraw()
+    return [ set_used.name, missing_list ]
+
+selection_sets_expressions = {}
+
+def selection_sets_expression(expression):
+    """Parses a selection set expression, cached per expression. Set names can be quoted,
+    unquoted names may contain spaces but no operators. & binds stronger than +, | and -,
+    parentheses group.
+    Returns: Tuple of expression tree and list of set names.
+    """
+    parsed = selection_sets_expressions.get(expression)
+    if parsed is not None:
+        return parsed
+
+    tokens = []
+    bare = False
+    for token in re.findall(r'"[^"]*"|\'[^\']*\'|[()+|&-]|[^\s()+|&"\'-]+', expression):
+        if token in ('(', ')', '+', '|', '&', '-'):
+            tokens.append((token, None))
+            bare = False
+        elif token[0] in '"\'':
+            tokens.append(('NAME', token[1:-1]))
+            bare = False
+        elif bare:
+            tokens[-1] = ('NAME', tokens[-1][1] + " " + token)
         else:
-            armatures = [bpy.context.active_object.data]
+            tokens.append(('NAME', token))
+            bare = True
+    names = []
+    position = 0
+
+    def peek():
+        return tokens[position][0] if position < len(tokens) else None
+
+    def atom():
+        nonlocal position
+        kind = peek()
+        if kind == 'NAME':
+            name = tokens[position][1]
+            position += 1
+            if name not in names:
+                names.append(name)
+            return ('SET', name)
+        if kind == '(':
+            position += 1
+            node = union()
+            if peek() != ')':
+                raise ValueError("Missing closing parenthesis in: " + expression)
+            position += 1
+            return node
+        raise ValueError("Expected a set name in: " + expression)
+
+    def intersection():
+        nonlocal position
+        node = atom()
+        while peek() == '&':
+            position += 1
+            node = ('&', node, atom())
+        return node
+
+    def union():
+        nonlocal position
+        node = intersection()
+        while peek() in ('+', '|', '-'):
+            operator = peek()
+            position += 1
+            node = (operator, node, intersection())
+        return node
+
+    tree = union()
+    if position < len(tokens):
+        raise ValueError("Unexpected '" + str(tokens[position][1] or tokens[position][0]) + "' in: " + expression)
+    parsed = selection_sets_expressions[expression] = (tree, names)
+    return parsed
+
+def selection_sets_evaluate(tree, bones):
+    """Evaluates a parsed selection set expression over resolved sets of bone names.
+    Returns: Set of bone names.
+    """
+    if tree[0] == 'SET':
+        return bones[tree[1]]
+    left = selection_sets_evaluate(tree[1], bones)
+    right = selection_sets_evaluate(tree[2], bones)
+    if tree[0] == '&':
+        return left & right
+    if tree[0] == '-':
+        return left - right
+    return left | right
+
+def selection_sets_combine(context, expression, select=True, clear=False):
+    """Selects the bones resulting from an expression over selection sets, using + or |
+    for union, & for intersection and - for difference. Every rig gets a single
+    bulk selection write.
+    Returns: List of selected bone count and missing bones list.
+    """
+    blatools = context.window_manager.blatools
+    sets = context.scene.blatools.selection_sets
+    tree, names = selection_sets_expression(expression)
+    used = []
+    for name in names:
+        position = selection_sets_index(context.scene, name)
+        if position is None:
+            raise KeyError(name)
+        used.append(sets[position])
+    if clear:
+        bpy.ops.pose.select_all(action='DESELECT')
+
+    count = 0
+    missing_list = []
+    for obj in selection_sets_rigs(context, [sel_set.source for sel_set in used]):
+        arma = obj.data
+        bones = {}
+        active_name = None
+        for sel_set in used:
+            set_bones, set_active = selection_set_bones(sel_set, obj)
+            bones[sel_set.name] = set(set_bones)
+            if active_name is None:
+                active_name = set_active
+        result = selection_sets_evaluate(tree, bones)
+        missing = result.difference(bone_indices(arma))
+        result -= missing
+        if not select or blatools.selection_sets_make_active != 'SET' or active_name not in result:
+            active_name = None
+        bones_select(arma, result, select, active_name=active_name)
+        count += len(result)
+        missing_list.extend(arma.name + ": " + name for name in sorted(missing))
+    ui_redraw()
+    return [count, missing_list]
+
+def selection_sets_create(context, selection_set, icon=None, mode=None, pattern=''):
+    """Creates a selection set from the selected pose bones, or a dynamic one from a
+    pattern. An existing set of the same name keeps its position and, unless given,
+    its icon and mode.
+    Returns: Selection set.
+    """
+    sets = context.scene.blatools.selection_sets
+    position = selection_sets_index(context.scene, selection_set)
+    if position is None:
+        sel_set = sets.add()
+        sel_set.name = selection_set
+        selection_sets_changed(context.scene)
     else:
-        armatures = [bpy.data.objects[blatools.selection_sets_filter_rig].data]
-
-    if set_used:
-        for arma in armatures:
-            for bone in set_used['bones']:
-                bone_name = dict(bone)['name']
-                if bone_name in arma.bones:
-                    arma.bones[bone_name].select = select
-                    if select and blatools.selection_sets_make_active == 'SET' and dict(bone)['active']:
-                        arma.bones.active = arma.bones[bone_name]
-                else:
-                    missing_list.append(arma.name + ": " + bone_name)
-    return [ set_used['name'], missing_list ]
+        sel_set = sets[position]
+        sel_set.bones.clear()
+        selection_sets_changed(context.scene, names=False)
+    if icon:
+        sel_set.icon = icon
+    if mode:
+        sel_set.mode = mode
+        sel_set.pattern = pattern if mode != 'STATIC' else ""
+    sel_set.source = context.active_object.name
 
-def selection_sets_create(context, selection_set, position, icon):
-    if 'blatools_selection_sets' not in context.scene:
-        context.scene['blatools_selection_sets'] = {}
-    bones = []
+    if sel_set.mode != 'STATIC':
+        return sel_set
     if context.active_pose_bone:
         active_name = context.active_pose_bone.name
     else:
         active_name = context.selected_pose_bones[0].name
+    names = set()
     for bone in context.selected_pose_bones:
-        if bone.name not in (b['name'] for b in bones):
-            if bone.name == active_name:
-                active = True
-            else:
-                active = False
-            bones.append({
-                'name': bone.name,
-                'active': active
-            })
-
-    context.scene['blatools_selection_sets'][selection_set] = {
-        'name': selection_set,
-        'icon': icon,
-        'source': context.active_object.name,
-        'position': position,
-        'bones': bones,
-    }
+        if bone.name not in names:
+            names.add(bone.name)
+            set_bone = sel_set.bones.add()
+            set_bone.name = bone.name
+            set_bone.active = bone.name == active_name
+    return sel_set
 
 def selection_sets_delete(context, selection_set):
-    position = context.scene['blatools_selection_sets'][selection_set]['position']
-    for sel_set in context.scene['blatools_selection_sets']:
-        if dict(context.scene['blatools_selection_sets'][sel_set])['position'] > position:
-            context.scene['blatools_selection_sets'][sel_set]['position'] -= 1
-    del context.scene['blatools_selection_sets'][selection_set]
-    if not context.scene['blatools_selection_sets']:
-        del context.scene['blatools_selection_sets']
+    scene_blatools = context.scene.blatools
+    position = selection_sets_index(context.scene, selection_set)
+    if position is not None:
+        scene_blatools.selection_sets.remove(position)
+        if scene_blatools.selection_sets_index >= len(scene_blatools.selection_sets):
+            scene_blatools.selection_sets_index = max(0, len(scene_blatools.selection_sets) - 1)
+        selection_sets_changed(context.scene)
 
 def selection_sets_reorder(context, up, position):
-    for name in dict(context.scene['blatools_selection_sets']):
-        if context.scene['blatools_selection_sets'][name]['position'] == position:
-            if up:
-                context.scene['blatools_selection_sets'][name]['position'] = position - 1
+    scene_blatools = context.scene.blatools
+    sets = scene_blatools.selection_sets
+    target = position - 1 if up else position + 1
+    if 0 <= position < len(sets) and 0 <= target < len(sets):
+        index = selection_sets_indices.get(context.scene.as_pointer())
+        if index is not None:
+            index[sets[position].name] = target
+            index[sets[target].name] = position
+        sets.move(position, target)
+        if scene_blatools.selection_sets_index == position:
+            scene_blatools.selection_sets_index = target
+        selection_sets_changed(context.scene, names=False)
+
+selection_sets_libraries = {}
+
+def selection_sets_library_path(context):
+    """Gets the selection set library file from the add-on preferences, defaults to
+    a file in the user config folder.
+    Returns: String.
+    """
+    addon = context.preferences.addons.get(__package__)
+    filepath = addon.preferences.selection_sets_library if addon else ""
+    if not filepath:
+        filepath = os.path.join(bpy.utils.user_resource('CONFIG'), 'blatools_selection_sets.json')
+    return bpy.path.abspath(filepath)
+
+def selection_sets_library_load(filepath):
+    """Reads a selection set library. Files are parsed once and cached until their
+    modification time changes.
+    Returns: Dictionary of rig name: list of selection sets.
+    """
+    try:
+        mtime = os.path.getmtime(filepath)
+    except OSError:
+        return {}
+    cached = selection_sets_libraries.get(filepath)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(filepath, encoding='utf-8') as f:
+        rigs = json.load(f).get('rigs', {})
+    selection_sets_libraries[filepath] = (mtime, rigs)
+    return rigs
+
+def selection_sets_library_save(context, filepath, rigs):
+    """Writes the selection sets of the given rigs to a library, replacing the
+    entries of those rigs and keeping all others.
+    Returns: Integer, number of sets written.
+    """
+    library = dict(selection_sets_library_load(filepath))
+    entries = {rig: [] for rig in rigs}
+    for sel_set in context.scene.blatools.selection_sets:
+        if sel_set.source in entries:
+            entries[sel_set.source].append({
+                'name': sel_set.name,
+                'icon': sel_set.icon,
+                'mode': sel_set.mode,
+                'pattern': sel_set.pattern,
+                'bones': [[bone.name, bone.active] for bone in sel_set.bones]
+            })
+    library.update(entries)
+
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filepath + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'version': 1, 'rigs': library}, f, indent=1)
+    os.replace(filepath + '.tmp', filepath)
+    selection_sets_libraries[filepath] = (os.path.getmtime(filepath), library)
+    return sum(len(sets) for sets in entries.values())
+
+def selection_sets_library_apply(context, filepath, rigs):
+    """Creates the library selection sets of the given rigs in the current scene in
+    one pass. Sets of the same name are overwritten in place.
+    Returns: Integer, number of sets applied.
+    """
+    library = selection_sets_library_load(filepath)
+    sets = context.scene.blatools.selection_sets
+    existing = {sel_set.name: sel_set for sel_set in sets}
+    count = 0
+    for rig in rigs:
+        for entry in library.get(rig, []):
+            sel_set = existing.get(entry['name'])
+            if sel_set is None:
+                sel_set = existing[entry['name']] = sets.add()
+                sel_set.name = entry['name']
             else:
-                context.scene['blatools_selection_sets'][name]['position'] = position + 1
-        elif up and context.scene['blatools_selection_sets'][name]['position'] == position - 1:
-            context.scene['blatools_selection_sets'][name]['position'] = position
-        elif not up and context.scene['blatools_selection_sets'][name]['position'] == position + 1:
-            context.scene['blatools_selection_sets'][name]['position'] = position
+                sel_set.bones.clear()
+            sel_set.icon = entry.get('icon', 'BLANK1')
+            sel_set.mode = entry.get('mode', 'STATIC')
+            sel_set.pattern = entry.get('pattern', "")
+            sel_set.source = rig
+            for name, active in entry.get('bones', []):
+                set_bone = sel_set.bones.add()
+                set_bone.name = name
+                set_bone.active = active
+            count += 1
+    if count:
+        selection_sets_changed(context.scene)
+    return count
 
-def collection_alpha_reset(context):
-    blatools = context.window_manager.blatools
-    blatools.collection_alpha = 1.0
-    for mat in bpy.data.materials:
-        if mat.name.endswith("_blatools_alpha"):
-            bpy.data.materials.remove(mat)
+alpha_snapshot_keys = {}
+
+def alpha_snapshot_index(scene):
+    """Gets the (datablock pointer, kind) pairs recorded in the snapshot table of a scene.
+    Returns: Set.
+    """
+    keys = alpha_snapshot_keys.get(scene.as_pointer())
+    if keys is None:
+        keys = alpha_snapshot_keys[scene.as_pointer()] = {
+            (entry.target.as_pointer(), entry.kind) for entry in scene.blatools.alpha_snapshots if entry.target
+        }
+    return keys
+
+def alpha_snapshot(scene, target, kind, value):
+    """Records the original value of a datablock changed by collection alpha, only the
+    first time it gets changed. Snapshots are stored in one table per scene.
+    Returns: None.
+    """
+    keys = alpha_snapshot_index(scene)
+    key = (target.as_pointer(), kind)
+    if key not in keys:
+        keys.add(key)
+        entry = scene.blatools.alpha_snapshots.add()
+        entry.target = target
+        entry.kind = kind
+        entry.value = value
+
+def alpha_snapshot_restore(scene, targets=None, shared=(), ghosts=None):
+    """Restores the original values recorded for the given datablock pointers, or for
+    everything, and drops their entries. The given ghost materials, all of them by
+    default, are taken out of the slots and drivers they were put in. Shared pointers
+    are still used by other layers, only the ghosts are taken out of them. Entries of
+    ghost materials are only dropped when restoring everything.
+    Returns: List of ghost materials that are no longer recorded.
+    """
+    snapshots = scene.blatools.alpha_snapshots
+    if ghosts is None:
+        ghosts = {pointer for pointer, kind in alpha_snapshot_index(scene) if kind == 'GHOST'}
+    keep = []
+    dropped = []
+
+    # Drivers go first, they would override the restored values
+    for entry in snapshots:
+        target = entry.target
+        if entry.kind == 'DRIVER' and target and (targets is None or target.as_pointer() in targets):
+            for path in alpha_driver_paths:
+                if alpha_driver_ghost(target, path, ghosts):
+                    target.driver_remove(path, 3)
+
+    for entry in snapshots:
+        target = entry.target
+        if target is None:
+            continue
+        pointer = target.as_pointer()
+        if targets is not None and pointer not in targets:
+            keep.append((target, entry.kind, entry.value))
+            continue
+        if pointer in shared:
+            keep.append((target, entry.kind, entry.value))
+            if entry.kind not in ('SLOT', 'APPEND'):
+                continue
+        if entry.kind == 'COLOR':
+            target.color[3] = entry.value
+        elif entry.kind == 'IMAGE':
+            target.use_empty_image_alpha = bool(entry.value)
+        elif entry.kind == 'STROKE':
+            target.grease_pencil.color[3] = entry.value
+        elif entry.kind == 'FILL':
+            target.grease_pencil.fill_color[3] = entry.value
+        elif entry.kind == 'DIFFUSE':
+            target.diffuse_color[3] = entry.value
+        elif entry.kind == 'SLOT':
+            for slot in target.material_slots:
+                if slot.material and slot.material.as_pointer() in ghosts:
+                    slot.material = None
+        elif entry.kind == 'APPEND':
+            for i in reversed(range(len(target.materials))):
+                mat = target.materials[i]
+                if mat and mat.as_pointer() in ghosts:
+                    target.materials.pop(index=i)
+        elif entry.kind == 'GHOST':
+            dropped.append(target)
+    snapshots.clear()
+    for target, kind, value in keep:
+        entry = snapshots.add()
+        entry.target = target
+        entry.kind = kind
+        entry.value = value
+    alpha_snapshot_keys.pop(scene.as_pointer(), None)
+    return dropped
+
+@bpy.app.handlers.persistent
+def collection_alpha_migrate(*args):
+    """Moves original values stored in custom properties by older versions into the
+    snapshot table of the current scene.
+    Returns: None.
+    """
+    scene = bpy.context.scene or bpy.data.scenes[0]
     for obj in bpy.data.objects:
-        if "blatools_alpha_tmp" in obj:
-            obj.color[3] = obj["blatools_alpha_tmp"]
-            del obj["blatools_alpha_tmp"]
-        if "blatools_image_tmp" in obj:
-            obj.use_empty_image_alpha = obj["blatools_image_tmp"]
-            del obj["blatools_image_tmp"]
+        for kind, prop in (('COLOR', 'blatools_alpha_tmp'), ('IMAGE', 'blatools_image_tmp')):
+            if prop in obj:
+                alpha_snapshot(scene, obj, kind, float(obj[prop]))
+                del obj[prop]
     for mat in bpy.data.materials:
-        if mat.is_grease_pencil:
-            if "blatools_stroke_tmp" in mat:
-                mat.grease_pencil.color[3] = mat["blatools_stroke_tmp"]
-                del mat["blatools_stroke_tmp"]
-            if "blatools_fill_tmp" in mat:
-                mat.grease_pencil.fill_color[3] = mat["blatools_fill_tmp"]
-                del mat["blatools_fill_tmp"]
+        if mat.name.endswith("_blatools_alpha"):
+            alpha_snapshot(scene, mat, 'GHOST', 1.0)
+        for kind, prop in (('STROKE', 'blatools_stroke_tmp'), ('FILL', 'blatools_fill_tmp'), ('DIFFUSE', 'blatools_alpha_tmp')):
+            if prop in mat:
+                alpha_snapshot(scene, mat, kind, float(mat[prop]))
+                del mat[prop]
+
+def alpha_ghost(scene):
+    """Takes a ghost material from the pool of recorded ghost materials that no alpha
+    layer uses, creating a new one only when the pool is empty.
+    Returns: Material.
+    """
+    used = {layer.ghost.as_pointer() for layer in scene.blatools.alpha_layers if layer.ghost}
+    for entry in scene.blatools.alpha_snapshots:
+        if entry.kind == 'GHOST' and entry.target and entry.target.as_pointer() not in used:
+            entry.target.diffuse_color[3] = 1.0
+            return entry.target
+    ghost = bpy.data.materials.new('blatools_alpha_ghost')
+    alpha_snapshot(scene, ghost, 'GHOST', 1.0)
+    return ghost
+
+alpha_driver_paths = ('color', 'diffuse_color', 'grease_pencil.color', 'grease_pencil.fill_color')
+
+def alpha_driver_ghost(target, path, ghosts):
+    """Checks whether the alpha of a color property is driven by a ghost material.
+    Returns: Boolean.
+    """
+    if not target.animation_data:
+        return False
+    fcurve = target.animation_data.drivers.find(path, index=3)
+    if fcurve is None:
+        return False
+    for var in fcurve.driver.variables:
+        if var.targets[0].id and var.targets[0].id.as_pointer() in ghosts:
+            return True
+    return False
+
+def alpha_driver(target, path, ghost):
+    """Drives the alpha of a color property by the diffuse alpha of a ghost material,
+    unless the property already has a driver.
+    Returns: True if the property is driven by this ghost material.
+    """
+    if target.animation_data and target.animation_data.drivers.find(path, index=3):
+        return alpha_driver_ghost(target, path, {ghost.as_pointer()})
+    driver = target.driver_add(path, 3).driver
+    driver.type = 'AVERAGE'
+    var = driver.variables.new()
+    var.name = 'alpha'
+    var.type = 'SINGLE_PROP'
+    var.targets[0].id_type = 'MATERIAL'
+    var.targets[0].id = ghost
+    var.targets[0].data_path = 'diffuse_color[3]'
+    return True
+
+collection_alpha_indices = {}
+
+def collection_alpha_index(scene, layer):
+    """Gets the index of datablocks affected by an alpha layer, each one listed once:
+    objects, image empties, materials, grease pencil materials, empty material slots
+    and object data without any material slots. Indices are rebuilt when marked dirty.
+    Returns: Dictionary.
+    """
+    key = (scene.as_pointer(), layer.name)
+    collection = layer.collection
+    index = collection_alpha_indices.get(key)
+    if index is not None and not index['dirty'] and index['collection'] == (collection.as_pointer() if collection else None):
+        return index
+
+    index = collection_alpha_indices[key] = {
+        'collection': collection.as_pointer() if collection else None,
+        'dirty': False,
+        'prepared': False,
+        'objects': [],
+        'images': [],
+        'materials': {},
+        'gpencil': {},
+        'slots': [],
+        'data': {},
+        'direct': []
+    }
+    if collection is None:
+        return index
+    ghosts = {pointer for pointer, kind in alpha_snapshot_index(scene) if kind == 'GHOST'}
+    for obj in collection.all_objects:
+        index['objects'].append(obj)
+        # Slots of objects lag behind materials just popped from their data
+        materials = getattr(obj.data, 'materials', None)
+        if materials is not None and not len(materials):
+            if obj.type != 'GPENCIL':
+                index['data'][obj.data.as_pointer()] = obj.data
         else:
-            if "blatools_alpha_tmp" in mat:
-                mat.diffuse_color[3] = mat["blatools_alpha_tmp"]
-                del mat["blatools_alpha_tmp"]
+            for i, slot in enumerate(obj.material_slots):
+                mat = slot.material
+                if not mat:
+                    index['slots'].append((obj, i))
+                elif mat.as_pointer() not in ghosts:
+                    index['gpencil' if mat.is_grease_pencil else 'materials'][mat.as_pointer()] = mat
+        if obj.type == 'EMPTY' and obj.empty_display_type == 'IMAGE':
+            index['images'].append(obj)
+    return index
 
-def collection_alpha_set(self, context):
-    blatools = context.window_manager.blatools
-    collection = blatools.collection_alpha_collection
-    ghostmat = collection + '_blatools_alpha'
-    if not ghostmat in bpy.data.materials:
-        bpy.data.materials.new(ghostmat)
-    bpy.data.materials[ghostmat].diffuse_color[3] = blatools.collection_alpha
-    if collection:
-        for obj in bpy.data.collections[collection].all_objects:
-            if not 'blatools_alpha_tmp' in obj:
-                obj['blatools_alpha_tmp'] = obj.color[3]
-            obj.color[3] = blatools.collection_alpha
-            if obj.material_slots:
-                for slot in obj.material_slots:
-                    if slot.material:
-                        mat = slot.material
-                        if mat is not bpy.data.materials[ghostmat]:
-                            if mat.is_grease_pencil:
-                                if not 'blatools_stroke_tmp' in mat:
-                                    mat['blatools_stroke_tmp'] = mat.grease_pencil.color[3]
-                                if not 'blatools_fill_tmp' in mat:
-                                    mat['blatools_stroke_tmp'] = mat.grease_pencil.fill_color[3]
-                                mat.grease_pencil.color[3] = blatools.collection_alpha
-                                mat.grease_pencil.fill_color[3] = blatools.collection_alpha
-                            else:
-                                if not 'blatools_alpha_tmp' in mat:
-                                    mat['blatools_alpha_tmp'] = mat.diffuse_color[3]
-                                mat.diffuse_color[3] = blatools.collection_alpha
-                    else:
-                        try:
-                            slot.material = bpy.data.materials[ghostmat]
-                        except:
-                            None
-            else:
-                if obj.type is not 'GPENCIL':
-                    try:
-                        obj.data.materials.append(bpy.data.materials[ghostmat])
-                    except:
-                        None
-            if obj.type == 'EMPTY':
-                if obj.empty_display_type == 'IMAGE':
-                    if not 'blatools_image_tmp' in obj:
-                        obj['blatools_image_tmp'] = obj.use_empty_image_alpha
-                    obj.use_empty_image_alpha = True
-
-def collections_iterate(collection, excluded=True, collections=[]):
-    if not excluded and not collection.exclude:
-        for child in collection.children:
-            if child.name not in collections:
-                collections.append(child.name)
-            if child.children:
-                collections = (collections_iterate(child, excluded, collections))
-    return collections
+def alpha_layer_apply(scene, layer):
+    """Applies the alpha of a layer in one pass over the datablocks of its collection.
+    Original values are recorded once per index, later passes only write the alpha.
+    In driver mode the datablocks are driven by the ghost material instead, so later
+    passes only write the ghost alpha and properties that were already driven.
+    Returns: None.
+    """
+    alpha = layer.alpha
+    if not layer.ghost:
+        layer.ghost = alpha_ghost(scene)
+    ghost = layer.ghost
+    ghost.diffuse_color[3] = alpha
+
+    index = collection_alpha_index(scene, layer)
+    if not index['prepared']:
+        for obj in index['objects']:
+            alpha_snapshot(scene, obj, 'COLOR', obj.color[3])
+        for obj in index['images']:
+            alpha_snapshot(scene, obj, 'IMAGE', float(obj.use_empty_image_alpha))
+            obj.use_empty_image_alpha = True
+        for mat in index['gpencil'].values():
+            alpha_snapshot(scene, mat, 'STROKE', mat.grease_pencil.color[3])
+            alpha_snapshot(scene, mat, 'FILL', mat.grease_pencil.fill_color[3])
+        for mat in index['materials'].values():
+            alpha_snapshot(scene, mat, 'DIFFUSE', mat.diffuse_color[3])
+        for obj, i in index['slots']:
+            try:
+                obj.material_slots[i].material = ghost
+                alpha_snapshot(scene, obj, 'SLOT', 0.0)
+            except:
+                None
+        for data in index['data'].values():
+            try:
+                data.materials.append(ghost)
+                alpha_snapshot(scene, data, 'APPEND', 0.0)
+            except:
+                None
+        if layer.drivers:
+            paths = [(obj, 'color') for obj in index['objects']]
+            for mat in index['gpencil'].values():
+                paths.append((mat, 'grease_pencil.color'))
+                paths.append((mat, 'grease_pencil.fill_color'))
+            paths.extend((mat, 'diffuse_color') for mat in index['materials'].values())
+            for target, path in paths:
+                if alpha_driver(target, path, ghost):
+                    alpha_snapshot(scene, target, 'DRIVER', 0.0)
+                else:
+                    index['direct'].append((target, path))
+        index['prepared'] = True
+
+    if layer.drivers:
+        for target, path in index['direct']:
+            target.path_resolve(path)[3] = alpha
+        return
+
+    for obj in index['objects']:
+        obj.color[3] = alpha
+    for mat in index['gpencil'].values():
+        mat.grease_pencil.color[3] = alpha
+        mat.grease_pencil.fill_color[3] = alpha
+    for mat in index['materials'].values():
+        mat.diffuse_color[3] = alpha
+
+collection_alpha_interval = 1.0 / 60.0
+collection_alpha_pending = set()
+
+def alpha_layer_update(self, context):
+    """Update of alpha layer sliders. Changes are coalesced by a timer, so a drag
+    applies only the latest value of each changed layer, at most once per UI frame.
+    Returns: None.
+    """
+    collection_alpha_pending.add((self.id_data.name, self.name))
+    if bpy.app.background:
+        collection_alpha_apply()
+    elif not bpy.app.timers.is_registered(collection_alpha_apply):
+        bpy.app.timers.register(collection_alpha_apply, first_interval=collection_alpha_interval)
+
+def collection_alpha_apply():
+    """Applies all alpha layers changed since the last call.
+    Returns: None.
+    """
+    for scene_name, name in collection_alpha_pending:
+        scene = bpy.data.scenes.get(scene_name)
+        if scene and name in scene.blatools.alpha_layers:
+            alpha_layer_apply(scene, scene.blatools.alpha_layers[name])
+    collection_alpha_pending.clear()
+
+def alpha_layer_add(context, collection):
+    """Adds an alpha layer for a collection and indexes its datablocks, or activates
+    the existing layer of that collection.
+    Returns: Alpha layer.
+    """
+    scene_blatools = context.scene.blatools
+    layers = scene_blatools.alpha_layers
+    position = layers.find(collection)
+    if position < 0:
+        layer = layers.add()
+        layer.name = collection
+        layer.collection = bpy.data.collections[collection]
+        layer.ghost = alpha_ghost(context.scene)
+        position = len(layers) - 1
+    scene_blatools.alpha_layers_index = position
+    collection_alpha_index(context.scene, layers[position])
+    return layers[position]
+
+def alpha_layer_targets(index):
+    """Gets the pointers of all datablocks in the index of an alpha layer.
+    Returns: Set.
+    """
+    targets = set(index['materials']).union(index['gpencil'])
+    for obj in index['objects']:
+        targets.add(obj.as_pointer())
+        if obj.data:
+            targets.add(obj.data.as_pointer())
+    return targets
+
+def alpha_layer_restore(scene, layer):
+    """Restores the datablocks of the collection of an alpha layer and drops its index.
+    Datablocks other layers use as well keep their snapshots, only the ghost material
+    of this layer is taken out of them.
+    Returns: List of names of the layers sharing datablocks with this one.
+    """
+    targets = alpha_layer_targets(collection_alpha_index(scene, layer))
+    shared = set()
+    sharing = []
+    for other in scene.blatools.alpha_layers:
+        if other.name != layer.name:
+            common = targets.intersection(alpha_layer_targets(collection_alpha_index(scene, other)))
+            if common:
+                shared.update(common)
+                sharing.append(other.name)
+    alpha_snapshot_restore(scene, targets, shared, {layer.ghost.as_pointer()} if layer.ghost else set())
+    collection_alpha_indices.pop((scene.as_pointer(), layer.name), None)
+    return sharing
+
+def alpha_layers_reapply(scene, names):
+    """Indexes and applies alpha layers again, after shared datablocks lost the ghost
+    material of another layer.
+    Returns: None.
+    """
+    layers = scene.blatools.alpha_layers
+    for name in names:
+        if name in layers:
+            collection_alpha_indices.pop((scene.as_pointer(), name), None)
+            alpha_layer_apply(scene, layers[name])
+
+def alpha_layer_drivers_update(self, context):
+    """Update of the driver mode of alpha layers, restores the collection and applies
+    the alpha again in the new mode.
+    Returns: None.
+    """
+    sharing = alpha_layer_restore(self.id_data, self)
+    alpha_layer_apply(self.id_data, self)
+    alpha_layers_reapply(self.id_data, sharing)
+
+def alpha_layer_remove(context, position):
+    """Removes an alpha layer, restoring the datablocks of its collection. Its ghost
+    material goes back to the pool.
+    Returns: None.
+    """
+    scene = context.scene
+    scene_blatools = scene.blatools
+    layer = scene_blatools.alpha_layers[position]
+    sharing = alpha_layer_restore(scene, layer)
+    if layer.ghost:
+        layer.ghost.diffuse_color[3] = 1.0
+    collection_alpha_pending.discard((scene.name, layer.name))
+    scene_blatools.alpha_layers.remove(position)
+    scene_blatools.alpha_layers_index = min(scene_blatools.alpha_layers_index, max(0, len(scene_blatools.alpha_layers) - 1))
+    alpha_layers_reapply(scene, sharing)
+
+def collection_alpha_reset(context):
+    """Removes all alpha layers, restores every datablock recorded in the snapshot
+    tables and removes the ghost materials, without looking at anything that was not
+    changed.
+    Returns: None.
+    """
+    if bpy.app.timers.is_registered(collection_alpha_apply):
+        bpy.app.timers.unregister(collection_alpha_apply)
+    collection_alpha_pending.clear()
+    collection_alpha_indices.clear()
+    ghosts = {}
+    for scene in bpy.data.scenes:
+        scene.blatools.alpha_layers.clear()
+        for ghost in alpha_snapshot_restore(scene):
+            ghosts[ghost.as_pointer()] = ghost
+    for mat in ghosts.values():
+        bpy.data.materials.remove(mat)
+
+layer_collections_cache = {}
+
+def layer_collections_walk(index, layer_collection, path, excluded):
+    """Adds the children of a layer collection to a layer collection index, collections
+    below excluded ones are kept in the tree but not offered as items.
+    Returns: None.
+    """
+    for child in layer_collection.children:
+        child_path = path + (child.name,)
+        index['tree'].append({
+            'name': child.name,
+            'path': " / ".join(child_path),
+            'depth': len(path),
+            'exclude': child.exclude
+        })
+        if not excluded and child.name not in index['names']:
+            index['names'].add(child.name)
+            index['items'].append((child.name, child.name, " / ".join(child_path), 'GROUP', len(index['items'])))
+        layer_collections_walk(index, child, child_path, excluded or child.exclude)
+
+def layer_collections(view_layer):
+    """Gets the layer collections of a view layer in tree order with their depth, exclude
+    state and path, plus enum items of the collections that are not below an excluded
+    one. Indices are kept until collections or scenes change, so the item list stays
+    referenced for enum callbacks.
+    Returns: Dictionary.
+    """
+    index = layer_collections_cache.get(view_layer.as_pointer())
+    if index is None:
+        index = layer_collections_cache[view_layer.as_pointer()] = {'tree': [], 'names': set(), 'items': []}
+        layer_collections_walk(index, view_layer.layer_collection, (), view_layer.layer_collection.exclude)
+    return index
+
+scene_armatures_cache = {}
+scene_armatures_numbers = {}
+
+def scene_armatures(scene):
+    """Gets enum items of the selection set rig filter for a scene: the filter modes
+    followed by all armature objects. Items keep their number for as long as the
+    session runs, numbers of new armatures keep growing.
+    Returns: List.
+    """
+    items = scene_armatures_cache.get(scene.as_pointer())
+    if items is None:
+        numbers = scene_armatures_numbers.setdefault(scene.as_pointer(), {})
+        items = scene_armatures_cache[scene.as_pointer()] = [
+            ('SOURCE', 'Source Rig', 'Source Rig', 'HEART', 0),
+            ('ACTIVE', 'Active Rig', 'Active Rig', 'OUTLINER_OB_ARMATURE', 1),
+            ('ALL', 'All Rigs', 'All Rigs', 'ORIENTATION_GLOBTL', 2)
+        ]
+        for obj in scene.objects:
+            if obj.type == 'ARMATURE':
+                if obj.name not in numbers:
+                    numbers[obj.name] = len(numbers) + 3
+                items.append((obj.name, obj.name, obj.name, 'ARMATURE_DATA', numbers[obj.name]))
+    return items
+
+def object_names_changed(*args):
+    """Drops the armature lists, called by the message bus on renames of objects.
+    Returns: None.
+    """
+    scene_armatures_cache.clear()
+
+@bpy.app.handlers.persistent
+def caches_clear(*args):
+    """Drops all cached indices, used after loading files and undo steps.
+    Returns: None.
+    """
+    action_indices.clear()
+    rest_matrices_cache.clear()
+    bone_indices_cache.clear()
+    bone_patterns_cache.clear()
+    selection_sets_indices.clear()
+    selection_sets_versions.clear()
+    selection_sets_models.clear()
+    collection_alpha_indices.clear()
+    alpha_snapshot_keys.clear()
+    layer_collections_cache.clear()
+    scene_armatures_cache.clear()
+    scene_armatures_numbers.clear()
+    motionpaths_snapshots.clear()
+
+@bpy.app.handlers.persistent
+def caches_update(scene, depsgraph):
+    """Drops cached indices of datablocks changed by the last depsgraph update.
+    Returns: None.
+    """
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Action):
+            action_indices.pop(update.id.original.as_pointer(), None)
+        elif isinstance(update.id, bpy.types.Armature):
+            # Rest poses also change outside edit mode, e.g. by applying the pose as rest
+            rest_matrices_cache.pop(update.id.original.as_pointer(), None)
+            if update.id.original.is_editmode:
+                bone_indices_cache.pop(update.id.original.as_pointer(), None)
+        elif isinstance(update.id, bpy.types.Collection):
+            layer_collections_cache.clear()
+            scene_armatures_cache.clear()
+            for index in collection_alpha_indices.values():
+                index['dirty'] = True
+        elif isinstance(update.id, bpy.types.Scene):
+            layer_collections_cache.clear()
+            scene_armatures_cache.clear()
+
+@bpy.app.handlers.persistent
+def msgbus_subscribe(*args):
+    """Subscribes to renames of bones and objects, subscriptions are lost when loading files.
+    Returns: None.
+    """
+    bpy.msgbus.clear_by_owner(bone_indices_cache)
+    bpy.msgbus.subscribe_rna(
+        key=(bpy.types.Bone, 'name'),
+        owner=bone_indices_cache,
+        args=(),
+        notify=bone_names_changed
+    )
+    bpy.msgbus.clear_by_owner(scene_armatures_cache)
+    bpy.msgbus.subscribe_rna(
+        key=(bpy.types.Object, 'name'),
+        owner=scene_armatures_cache,
+        args=(),
+        notify=object_names_changed
+    )
+
+def register():
+    bpy.app.handlers.depsgraph_update_post.append(caches_update)
+    for handlers in (
+                bpy.app.handlers.load_post,
+                bpy.app.handlers.undo_post,
+                bpy.app.handlers.redo_post
+            ):
+        handlers.append(caches_clear)
+    for handler in (selection_sets_migrate, collection_alpha_migrate, msgbus_subscribe):
+        bpy.app.handlers.load_post.append(handler)
+    msgbus_subscribe()
+    bpy.app.timers.register(selection_sets_migrate, first_interval=0.0)
+    bpy.app.timers.register(collection_alpha_migrate, first_interval=0.0)
+
+def unregister():
+    bpy.app.handlers.depsgraph_update_post.remove(caches_update)
+    for handlers in (
+                bpy.app.handlers.load_post,
+                bpy.app.handlers.undo_post,
+                bpy.app.handlers.redo_post
+            ):
+        handlers.remove(caches_clear)
+    for handler in (selection_sets_migrate, collection_alpha_migrate, msgbus_subscribe):
+        bpy.app.handlers.load_post.remove(handler)
+    bpy.msgbus.clear_by_owner(bone_indices_cache)
+    bpy.msgbus.clear_by_owner(scene_armatures_cache)
+    for timer in (selection_sets_migrate, collection_alpha_migrate, collection_alpha_apply):
+        if bpy.app.timers.is_registered(timer):
+            bpy.app.timers.unregister(timer)
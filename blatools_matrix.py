@@ -0,0 +1,287 @@
+import math
+import mathutils
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+##############################################################
+## Batches of 4x4 matrices, NumPy arrays of shape (N, 4, 4) ##
+## or plain lists of mathutils matrices as a fallback.      ##
+##############################################################
+
+euler_axes = {
+    'XYZ': ((0, 1, 2), False),
+    'XZY': ((0, 2, 1), True),
+    'YXZ': ((1, 0, 2), True),
+    'YZX': ((1, 2, 0), False),
+    'ZXY': ((2, 0, 1), False),
+    'ZYX': ((2, 1, 0), True)
+}
+
+def matrices_new(matrices):
+    """Creates a batch from a sequence of matrices.
+    Returns: Batch.
+    """
+    if numpy:
+        values = [v for m in matrices for row in m for v in row]
+        return numpy.array(values, dtype=numpy.float64).reshape(-1, 4, 4)
+    return [mathutils.Matrix(m) for m in matrices]
+
+def matrices_from_flat(values):
+    """Creates a batch from a flat sequence of floats, 16 per matrix in row order.
+    Returns: Batch.
+    """
+    if numpy:
+        return numpy.array(values, dtype=numpy.float64).reshape(-1, 4, 4)
+    return [
+        mathutils.Matrix([values[i + r * 4:i + r * 4 + 4] for r in range(4)])
+        for i in range(0, len(values), 16)
+    ]
+
+def matrices_flat(batch):
+    """Flattens a batch into a list of floats, 16 per matrix in row order.
+    Returns: List.
+    """
+    if numpy:
+        return batch.reshape(-1).tolist()
+    return [v for m in batch for row in m for v in row]
+
+def matrices_list(batch):
+    """Converts a batch into a list of mathutils matrices.
+    Returns: List of matrices.
+    """
+    if numpy:
+        return [mathutils.Matrix(m) for m in batch.tolist()]
+    return list(batch)
+
+def matrices_multiply(a, b):
+    """Multiplies two batches matrix by matrix. A batch holding a single matrix
+    is applied to every matrix of the other one.
+    Returns: Batch.
+    """
+    if numpy:
+        return numpy.matmul(a, b)
+    if len(a) == 1:
+        return [a[0] @ m for m in b]
+    if len(b) == 1:
+        return [m @ b[0] for m in a]
+    return [m_a @ m_b for m_a, m_b in zip(a, b)]
+
+def matrices_invert(batch):
+    """Inverts every matrix of a batch, singular matrices get their closest inverse
+    instead of raising an error.
+    Returns: Batch.
+    """
+    if numpy:
+        try:
+            return numpy.linalg.inv(batch)
+        except numpy.linalg.LinAlgError:
+            return numpy.linalg.pinv(batch)
+    return [m.inverted_safe() for m in batch]
+
+def matrices_compose(loc, rot, sca):
+    """Composes a batch from lists of locations, 3x3 rotation matrices (as returned
+    by rotations_to_matrices) and scales.
+    Returns: Batch.
+    """
+    if numpy:
+        batch = numpy.zeros((len(loc), 4, 4))
+        batch[:, :3, :3] = rot * numpy.asarray(sca, dtype=numpy.float64).reshape(-1, 3)[:, numpy.newaxis, :]
+        batch[:, :3, 3] = numpy.asarray(loc, dtype=numpy.float64).reshape(-1, 3)
+        batch[:, 3, 3] = 1.0
+        return batch
+    return [
+        mathutils.Matrix.Translation(l) @ r.to_4x4() @ mathutils.Matrix.Diagonal(tuple(s) + (1.0,))
+        for l, r, s in zip(loc, rot, sca)
+    ]
+
+def matrices_decompose(batch):
+    """Decomposes every matrix of a batch into location, 3x3 rotation matrix and scale.
+    Returns: Tuple of locations, rotations and scales.
+    """
+    if numpy:
+        loc = batch[:, :3, 3]
+        mat3 = batch[:, :3, :3]
+        sca = numpy.linalg.norm(mat3, axis=1)
+        negative = numpy.linalg.det(mat3) < 0.0
+        sca[negative] *= -1.0
+        sca_safe = numpy.where(sca == 0.0, 1.0, sca)
+        rot = mat3 / sca_safe[:, numpy.newaxis, :]
+        return loc, rot, sca
+    loc, rot, sca = [], [], []
+    for m in batch:
+        l, q, s = m.decompose()
+        loc.append(l)
+        rot.append(q.to_matrix())
+        sca.append(s)
+    return loc, rot, sca
+
+def rotations_to_matrices(values, rotation_mode='XYZ'):
+    """Converts per frame rotation values of any rotation mode into 3x3 rotation matrices.
+    Returns: Array of shape (N, 3, 3) or list of matrices.
+    """
+    if not numpy:
+        rot = []
+        for v in values:
+            if rotation_mode == 'QUATERNION':
+                rot.append(mathutils.Quaternion(v).normalized().to_matrix())
+            elif rotation_mode == 'AXIS_ANGLE':
+                rot.append(mathutils.Matrix.Rotation(v[0], 3, v[1:4]))
+            else:
+                rot.append(mathutils.Euler(v, rotation_mode).to_matrix())
+        return rot
+
+    values = numpy.asarray(values, dtype=numpy.float64).reshape(-1, 4 if rotation_mode in ('QUATERNION', 'AXIS_ANGLE') else 3)
+    if rotation_mode in ('QUATERNION', 'AXIS_ANGLE'):
+        if rotation_mode == 'AXIS_ANGLE':
+            axis = values[:, 1:4]
+            length = numpy.linalg.norm(axis, axis=1)[:, numpy.newaxis]
+            axis = numpy.where(length > 0.0, axis / numpy.where(length > 0.0, length, 1.0), [0.0, 1.0, 0.0])
+            half = values[:, 0:1] * 0.5
+            values = numpy.hstack((numpy.cos(half), axis * numpy.sin(half)))
+        length = numpy.linalg.norm(values, axis=1)[:, numpy.newaxis]
+        w, x, y, z = (values / numpy.where(length > 0.0, length, 1.0)).T
+        rot = numpy.empty((len(values), 3, 3))
+        rot[:, 0, 0] = 1.0 - 2.0 * (y * y + z * z)
+        rot[:, 0, 1] = 2.0 * (x * y - w * z)
+        rot[:, 0, 2] = 2.0 * (x * z + w * y)
+        rot[:, 1, 0] = 2.0 * (x * y + w * z)
+        rot[:, 1, 1] = 1.0 - 2.0 * (x * x + z * z)
+        rot[:, 1, 2] = 2.0 * (y * z - w * x)
+        rot[:, 2, 0] = 2.0 * (x * z - w * y)
+        rot[:, 2, 1] = 2.0 * (y * z + w * x)
+        rot[:, 2, 2] = 1.0 - 2.0 * (x * x + y * y)
+        return rot
+
+    # Euler, the first axis of the order is applied first
+    axes = []
+    for i in range(3):
+        c = numpy.cos(values[:, i])
+        s = numpy.sin(values[:, i])
+        m = numpy.zeros((len(values), 3, 3))
+        j, k = (i + 1) % 3, (i + 2) % 3
+        m[:, i, i] = 1.0
+        m[:, j, j] = c
+        m[:, j, k] = -s
+        m[:, k, j] = s
+        m[:, k, k] = c
+        axes.append(m)
+    order = ['XYZ'.index(a) for a in rotation_mode]
+    return axes[order[2]] @ axes[order[1]] @ axes[order[0]]
+
+def matrices_channels(batch, rotation_mode='XYZ'):
+    """Decomposes a batch into per channel value lists, all matrices at once.
+    Rotations are kept continuous from one matrix to the next.
+    Returns: Dictionary of property name: list of value lists, one per array index.
+    """
+    if rotation_mode == 'QUATERNION':
+        rotation = 'rotation_quaternion'
+    elif rotation_mode == 'AXIS_ANGLE':
+        rotation = 'rotation_axis_angle'
+    else:
+        rotation = 'rotation_euler'
+
+    # Fallback
+    if not numpy:
+        channels = {'location': [[], [], []], rotation: None, 'scale': [[], [], []]}
+        rot_values = []
+        rot_prev = None
+        for m in batch:
+            loc, quat, sca = m.decompose()
+            if rotation_mode == 'QUATERNION':
+                if rot_prev:
+                    quat.make_compatible(rot_prev)
+                rot_prev = quat
+                rot_values.append(tuple(quat))
+            elif rotation_mode == 'AXIS_ANGLE':
+                axis, angle = quat.to_axis_angle()
+                rot_values.append((angle, axis[0], axis[1], axis[2]))
+            else:
+                rot_prev = quat.to_euler(rotation_mode, rot_prev) if rot_prev else quat.to_euler(rotation_mode)
+                rot_values.append(tuple(rot_prev))
+            for i in range(3):
+                channels['location'][i].append(loc[i])
+                channels['scale'][i].append(sca[i])
+        channels[rotation] = [list(v) for v in zip(*rot_values)]
+        return channels
+
+    loc, rot, sca = matrices_decompose(batch)
+
+    # Euler, two solutions per matrix, the closer one to the previous frame wins
+    if rotation not in ('rotation_quaternion', 'rotation_axis_angle'):
+        (i, j, k), parity = euler_axes[rotation_mode]
+        cy = numpy.hypot(rot[:, i, i], rot[:, j, i])
+        e1 = numpy.empty((len(rot), 3))
+        e2 = numpy.empty((len(rot), 3))
+        e1[:, i] = numpy.arctan2(rot[:, k, j], rot[:, k, k])
+        e1[:, j] = numpy.arctan2(-rot[:, k, i], cy)
+        e1[:, k] = numpy.arctan2(rot[:, j, i], rot[:, i, i])
+        e2[:, i] = numpy.arctan2(-rot[:, k, j], -rot[:, k, k])
+        e2[:, j] = numpy.arctan2(-rot[:, k, i], -cy)
+        e2[:, k] = numpy.arctan2(-rot[:, j, i], -rot[:, i, i])
+        gimbal = cy <= 16.0 * 1.192092896e-07
+        e1[gimbal, i] = numpy.arctan2(-rot[gimbal, j, k], rot[gimbal, j, j])
+        e1[gimbal, k] = 0.0
+        e2[gimbal] = e1[gimbal]
+        if parity:
+            e1 = -e1
+            e2 = -e2
+        # The choice only depends on the previous choice: pick the cheaper solution
+        # for both possible predecessors at once, then walk the choices
+        pair = numpy.stack((e1, e2), axis=1)
+        delta = pair[1:, :, numpy.newaxis, :] - pair[:-1, numpy.newaxis, :, :]
+        cost = numpy.abs((delta + math.pi) % (2.0 * math.pi) - math.pi).sum(axis=3)
+        choice = [1 if numpy.abs(e1[0]).sum() > numpy.abs(e2[0]).sum() else 0] if len(pair) else []
+        for best in numpy.argmin(cost, axis=1).tolist():
+            choice.append(best[choice[-1]])
+        euler = pair[numpy.arange(len(pair)), choice]
+        rot_values = numpy.unwrap(euler, axis=0).T
+
+    # Quaternion, consecutive quaternions are kept on the same hemisphere
+    else:
+        # Shepperd's method: the largest of 4w², 4x², 4y², 4z² is taken as the square root,
+        # the other components are derived from it so that no sign gets lost
+        trace = rot[:, 0, 0] + rot[:, 1, 1] + rot[:, 2, 2]
+        squares = numpy.stack((
+            1.0 + trace,
+            1.0 + rot[:, 0, 0] - rot[:, 1, 1] - rot[:, 2, 2],
+            1.0 - rot[:, 0, 0] + rot[:, 1, 1] - rot[:, 2, 2],
+            1.0 - rot[:, 0, 0] - rot[:, 1, 1] + rot[:, 2, 2]
+        ), axis=1)
+        largest = numpy.argmax(squares, axis=1)
+        rows = numpy.arange(len(rot))
+        s = numpy.sqrt(numpy.maximum(squares[rows, largest], 1e-12)) * 2.0
+        wx = rot[:, 2, 1] - rot[:, 1, 2]
+        wy = rot[:, 0, 2] - rot[:, 2, 0]
+        wz = rot[:, 1, 0] - rot[:, 0, 1]
+        xy = rot[:, 0, 1] + rot[:, 1, 0]
+        xz = rot[:, 0, 2] + rot[:, 2, 0]
+        yz = rot[:, 1, 2] + rot[:, 2, 1]
+        candidates = numpy.stack((
+            numpy.stack((squares[:, 0], wx, wy, wz), axis=1),
+            numpy.stack((wx, squares[:, 1], xy, xz), axis=1),
+            numpy.stack((wy, xy, squares[:, 2], yz), axis=1),
+            numpy.stack((wz, xz, yz, squares[:, 3]), axis=1)
+        ), axis=1)
+        quat = candidates[rows, largest] / s[:, numpy.newaxis]
+        quat[quat[:, 0] < 0.0] *= -1.0
+        quat /= numpy.linalg.norm(quat, axis=1)[:, numpy.newaxis]
+        if rotation == 'rotation_quaternion':
+            flip = numpy.sum(quat[1:] * quat[:-1], axis=1) < 0.0
+            sign = numpy.cumprod(numpy.where(flip, -1.0, 1.0))
+            quat[1:] *= sign[:, numpy.newaxis]
+            rot_values = quat.T
+        else:
+            quat[quat[:, 0] < 0.0] *= -1.0
+            angle = 2.0 * numpy.arccos(numpy.clip(quat[:, 0], -1.0, 1.0))
+            s = numpy.sqrt(numpy.maximum(0.0, 1.0 - quat[:, 0] * quat[:, 0]))
+            axis = numpy.where(s[:, numpy.newaxis] > 1e-6, quat[:, 1:] / numpy.where(s > 1e-6, s, 1.0)[:, numpy.newaxis], [0.0, 1.0, 0.0])
+            rot_values = numpy.vstack((angle, axis.T))
+
+    return {
+        'location': loc.T.tolist(),
+        rotation: rot_values.tolist(),
+        'scale': sca.T.tolist()
+    }
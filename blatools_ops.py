@@ -1,4 +1,5 @@
 import bpy
+import re
 
 from . import blatools as bla
 
@@ -21,6 +22,23 @@ class BLATOOLS_OT_TransformStore(bpy.types.Operator):
     range_min: bpy.props.IntProperty(name="Start", default=1)
     range_max: bpy.props.IntProperty(name="End", default=250)
     trail: bpy.props.BoolProperty(name="Create Trail", default=False)
+    trail_mode: bpy.props.EnumProperty(
+        name="Trail Mode",
+        items=[
+            ('MESH', "Mesh", "One mesh with a vertex per keyframe, matrices are stored as point attributes"),
+            ('EMPTIES', "Empties", "One empty per keyframe")
+        ],
+        default='MESH'
+    )
+    selected: bpy.props.BoolProperty(name="All Selected", description="Store all selected bones or objects in one go, not only the active one", default=False)
+    evaluation: bpy.props.EnumProperty(
+        name="Evaluation",
+        items=[
+            ('CHAIN', "Chain", "Only evaluate the active object or bone and its parents, falls back to the scene if constraints, drivers or NLA are involved"),
+            ('SCENE', "Scene", "Evaluate the whole scene on every keyframe")
+        ],
+        default='CHAIN'
+    )
 
     @classmethod
     def poll(cls, context):
@@ -33,7 +51,10 @@ class BLATOOLS_OT_TransformStore(bpy.types.Operator):
             self.keyframes,
             self.range_min,
             self.range_max,
-            self.trail
+            self.trail,
+            self.evaluation,
+            self.trail_mode,
+            self.selected
         )
         bla.ui_redraw()
         return {"FINISHED"}
@@ -43,21 +64,30 @@ class BLATOOLS_OT_TransformStore(bpy.types.Operator):
         layout.row().prop(self, 'target', expand=True)
         row = layout.row()
         row.prop(self, 'keyframes', icon='DECORATE_KEYFRAME', expand=True)
-        if not self.target == 'EMPTY':
+        if self.target == 'CURSOR':
             row.enabled = False
         split = layout.split(align=True)
         row = split.row(align=True)
         row.prop(self, 'range_min')
-        if not self.target == 'EMPTY' or not self.keyframes:
+        if self.target == 'CURSOR' or not self.keyframes:
             row.enabled = False
         row = split.row(align=True)
         row.prop(self, 'range_max')
-        if not self.target == 'EMPTY' or not self.keyframes:
+        if self.target == 'CURSOR' or not self.keyframes:
             row.enabled = False
         row = layout.row(align=True)
         row.prop(self, 'trail')
+        row.prop(self, 'trail_mode', text="")
         if not self.target == 'EMPTY' or not self.keyframes:
             row.enabled = False
+        row = layout.row(align=True)
+        row.prop(self, 'selected')
+        if self.target == 'CURSOR':
+            row.enabled = False
+        row = layout.row(align=True)
+        row.prop(self, 'evaluation', expand=True)
+        if self.target == 'CURSOR' or not self.keyframes:
+            row.enabled = False
 
 class BLATOOLS_OT_TransformPaste(bpy.types.Operator):
     """Paste World Transforms to active Pose Bone or Object"""
@@ -69,22 +99,52 @@ class BLATOOLS_OT_TransformPaste(bpy.types.Operator):
         name="Source",
         items=[
             ('STORE', "Stored", "Stored"),
+            ('CLIPBOARD', "Stored Frames", "Paste onto all selected bones or objects with stored frames. Keys all stored frames, or pastes the current or only stored frame without keying"),
             ('CURSOR', "Cursor", "Cursor")
             #('SELECTION', "Selection", "Selection")
         ],
         default='STORE'
     )
+    frames: bpy.props.EnumProperty(
+        name="Frames",
+        items=[
+            ('CURRENT', "Current", "Paste on the current frame without keying"),
+            ('RANGE', "Range", "Paste and key every frame in range"),
+            ('KEYS', "Keyframes", "Paste and key every existing keyframe in range")
+        ],
+        default='CURRENT'
+    )
+    range_min: bpy.props.IntProperty(name="Start", default=1)
+    range_max: bpy.props.IntProperty(name="End", default=250)
+
     @classmethod
     def poll(cls, context):
         return context.active_pose_bone or context.active_object
 
     def execute(self, context):
-        bla.transform_paste(context, self.source)
+        bla.transform_paste(
+            context,
+            self.source,
+            self.frames,
+            self.range_min,
+            self.range_max
+        )
         return {"FINISHED"}
     
     def draw(self, context):
         layout = self.layout
         layout.row().prop(self, 'source', expand=True)
+        row = layout.row()
+        row.prop(self, 'frames', expand=True)
+        split = layout.split(align=True)
+        row = split.row(align=True)
+        row.prop(self, 'range_min')
+        if self.source == 'CLIPBOARD' or self.frames == 'CURRENT':
+            row.enabled = False
+        row = split.row(align=True)
+        row.prop(self, 'range_max')
+        if self.source == 'CLIPBOARD' or self.frames == 'CURRENT':
+            row.enabled = False
 
 class BLATOOLS_OT_MotionpathAuto(bpy.types.Operator):
     """Automatically create motion path for bones or objects"""
@@ -110,18 +170,33 @@ class BLATOOLS_OT_MotionpathAuto(bpy.types.Operator):
         if context.scene.use_preview_range:
             layout.row().prop(self, 'use_preview_range')
 
+class BLATOOLS_OT_MotionpathUpdateEdited(bpy.types.Operator):
+    """Recompute only the frames of motion paths affected by keyframe edits since they were created"""
+    bl_idname = 'pose.motionpath_update_edited'
+    bl_label = "Update Edited Motion Paths"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.selected_pose_bones or context.selected_objects
+
+    def execute(self, context):
+        count = bla.motionpaths_update(context)
+        if count is None:
+            self.report({'INFO'}, "Motion paths calculated again")
+        else:
+            self.report({'INFO'}, "Updated " + str(count) + " motion path frames")
+        return {"FINISHED"}
+
 class BLATOOLS_OT_CollectionAlphaSelect(bpy.types.Operator):
-    """Select collection for viewport alpha manipulation"""
+    """Add a collection as viewport alpha layer"""
     bl_idname = 'blatools.collection_alpha_select'
-    bl_label = "Select Collection for Viewport Alpha"
+    bl_label = "Add Collection Alpha Layer"
     bl_options = {'INTERNAL', 'UNDO'}
     bl_property = "enum_collections"
 
     def collections(self, context):
-        collections = []
-        for i, c in enumerate(bla.collections_iterate(context.view_layer.layer_collection, excluded=False)):
-            collections.append((c, c, c, 'GROUP', i))
-        return collections
+        return bla.layer_collections(context.view_layer)['items']
 
     enum_collections: bpy.props.EnumProperty(items=collections,default=None)
 
@@ -130,8 +205,7 @@ class BLATOOLS_OT_CollectionAlphaSelect(bpy.types.Operator):
         return context.view_layer.layer_collection.children
                 
     def execute(self, context):
-        blatools = context.window_manager.blatools
-        blatools.collection_alpha_collection = self.enum_collections
+        bla.alpha_layer_add(context, self.enum_collections)
         bla.ui_redraw()
         return {"FINISHED"}
     
@@ -139,6 +213,25 @@ class BLATOOLS_OT_CollectionAlphaSelect(bpy.types.Operator):
         context.window_manager.invoke_search_popup(self)
         return {'FINISHED'}
 
+class BLATOOLS_OT_CollectionAlphaRemove(bpy.types.Operator):
+    """Remove viewport alpha layer and restore its collection"""
+    bl_idname = 'blatools.collection_alpha_remove'
+    bl_label = "Remove Collection Alpha Layer"
+    bl_options = {'INTERNAL', 'UNDO'}
+
+    position: bpy.props.IntProperty(default=0)
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene.blatools.alpha_layers
+
+    def execute(self, context):
+        if self.position >= len(context.scene.blatools.alpha_layers):
+            return {'CANCELLED'}
+        bla.alpha_layer_remove(context, self.position)
+        bla.ui_redraw()
+        return {"FINISHED"}
+
 class BLATOOLS_OT_CollectionAlphaReset(bpy.types.Operator):
     """Reset viewport alpha for all collections"""
     bl_idname = 'blatools.collection_alpha_reset'
@@ -183,6 +276,38 @@ class BLATOOLS_OT_SelectionSetSelect(bpy.types.Operator):
         self.report({'INFO'}, report)
         return {"FINISHED"}
 
+class BLATOOLS_OT_SelectionSetsCombine(bpy.types.Operator):
+    """Select bones from an expression over selection sets: + or | for union, & for intersection, - for difference, parentheses to group. Quote names containing operators"""
+    bl_idname = 'pose.selection_sets_combine'
+    bl_label = "Combine Selection Sets"
+    bl_options = {'UNDO', 'REGISTER'}
+
+    expression: bpy.props.StringProperty(name="Expression")
+    select: bpy.props.BoolProperty(name="Select", default=True)
+    clear: bpy.props.BoolProperty(name="New Selection", default=True)
+
+    @classmethod
+    def poll(cls, context):
+        return context.mode == 'POSE'
+
+    def execute(self, context):
+        blatools = context.window_manager.blatools
+        try:
+            result = bla.selection_sets_combine(context, self.expression, self.select, self.clear)
+        except ValueError as error:
+            self.report({'ERROR'}, str(error))
+            return {'CANCELLED'}
+        except KeyError as error:
+            self.report({'ERROR'}, "Selection set " + str(error) + " not found.")
+            return {'CANCELLED'}
+        if result[1] and blatools.selection_sets_warnings:
+            def draw(self, context):
+                for bone in result[1]:
+                    self.layout.label(text=bone, icon='BONE_DATA')
+            context.window_manager.popup_menu(draw, title="Bones not found:", icon='ERROR')
+        self.report({'INFO'}, str(result[0]) + " bones " + ("selected!" if self.select else "deselected!"))
+        return {"FINISHED"}
+
 class BLATOOLS_OT_SelectionSetList(bpy.types.Operator):
     """List bones from selection set"""
     bl_idname = 'blatools.selection_sets_list'
@@ -192,9 +317,16 @@ class BLATOOLS_OT_SelectionSetList(bpy.types.Operator):
     selection_set: bpy.props.StringProperty()
                 
     def execute(self, context):
-        bones = []
-        for bone in dict(context.scene['blatools_selection_sets'][self.selection_set])['bones']:
-            bones.append(dict(bone)['name'])
+        position = bla.selection_sets_index(context.scene, self.selection_set)
+        if position is None:
+            return {'CANCELLED'}
+        sel_set = context.scene.blatools.selection_sets[position]
+        if sel_set.mode == 'STATIC':
+            bones = [bone.name for bone in sel_set.bones]
+        elif context.active_object and context.active_object.type == 'ARMATURE':
+            bones = bla.selection_set_bones(sel_set, context.active_object)[0]
+        else:
+            bones = []
         def draw(self, context):
             for bone in bones:
                 self.layout.label(text=bone, icon='BONE_DATA')
@@ -209,24 +341,27 @@ class BLATOOLS_OT_SelectionSetCreate(bpy.types.Operator):
 
     selection_set: bpy.props.StringProperty()
     icon: bpy.props.StringProperty(default='BLANK1')
+    mode: bpy.props.StringProperty(default='STATIC')
+    pattern: bpy.props.StringProperty(default="")
 
     @classmethod
     def poll(cls, context):
         blatools = context.window_manager.blatools
         if context.mode == 'POSE':
             if blatools.selection_sets_new_name:
-                if 'blatools_selection_sets' in context.scene:
-                    if not blatools.selection_sets_new_name in context.scene['blatools_selection_sets']:
-                        return context.selected_pose_bones
-                else:
-                    return context.selected_pose_bones and context.active_bone
+                if bla.selection_sets_index(context.scene, blatools.selection_sets_new_name) is None:
+                    if blatools.selection_sets_mode != 'STATIC':
+                        return blatools.selection_sets_pattern
+                    return context.selected_pose_bones
                 
     def execute(self, context):
-        if 'blatools_selection_sets' in context.scene:
-            position = len(context.scene['blatools_selection_sets'])
-        else:
-            position = 0
-        bla.selection_sets_create(context, self.selection_set, position, self.icon)
+        if self.mode == 'REGEX':
+            try:
+                bla.bone_pattern(self.mode, self.pattern)
+            except re.error as error:
+                self.report({'ERROR'}, "Invalid pattern: " + str(error))
+                return {'CANCELLED'}
+        bla.selection_sets_create(context, self.selection_set, self.icon, self.mode, self.pattern)
         bla.ui_redraw()
         return {"FINISHED"}
 
@@ -265,15 +400,7 @@ class BLATOOLS_OT_SelectionSetFilter(bpy.types.Operator):
     bl_property = "enum_rigs"
 
     def rigs(self, context):
-        rigs = [
-            ('SOURCE', 'Source Rig', 'Source Rig', 'HEART', 0),
-            ('ACTIVE', 'Active Rig', 'Active Rig', 'OUTLINER_OB_ARMATURE', 1),
-            ('ALL', 'All Rigs', 'All Rigs', 'ORIENTATION_GLOBTL', 2)
-        ]
-        for i, obj in enumerate(context.scene.objects):
-            if obj.type == 'ARMATURE':
-                rigs.append((obj.name, obj.name, obj.name, 'ARMATURE_DATA', i + 3))
-        return rigs
+        return bla.scene_armatures(context.scene)
 
     enum_rigs: bpy.props.EnumProperty(items=rigs,default=None)
 
@@ -325,9 +452,7 @@ class BLATOOLS_OT_SelectionSetUpdate(bpy.types.Operator):
             return context.selected_pose_bones
                 
     def execute(self, context):
-        position = dict(context.scene['blatools_selection_sets'][self.selection_set])['position']
-        icon = dict(context.scene['blatools_selection_sets'][self.selection_set])['icon']
-        bla.selection_sets_create(context, self.selection_set, position, icon)
+        bla.selection_sets_create(context, self.selection_set)
         bla.ui_redraw()
         return {"FINISHED"}
 
@@ -341,8 +466,80 @@ class BLATOOLS_OT_SelectionSetUpdateIcon(bpy.types.Operator):
                 
     def execute(self, context):
         blatools = context.window_manager.blatools
-        context.scene['blatools_selection_sets'][self.selection_set]['icon'] = blatools.selection_sets_icons
+        position = bla.selection_sets_index(context.scene, self.selection_set)
+        if position is None:
+            return {'CANCELLED'}
+        context.scene.blatools.selection_sets[position].icon = blatools.selection_sets_icons
+        bla.selection_sets_changed(context.scene, names=False)
+        bla.ui_redraw()
+        return {"FINISHED"}
+
+def selection_sets_library_rigs(context, rigs):
+    """Names of the armatures a library operator works on.
+    Returns: List of strings.
+    """
+    if rigs == 'ALL':
+        return [obj.name for obj in context.scene.objects if obj.type == 'ARMATURE']
+    names = [obj.name for obj in context.selected_objects if obj.type == 'ARMATURE']
+    if context.active_object and context.active_object.type == 'ARMATURE' and context.active_object.name not in names:
+        names.insert(0, context.active_object.name)
+    return names
+
+class BLATOOLS_OT_SelectionSetsExport(bpy.types.Operator):
+    """Export selection sets to the selection set library"""
+    bl_idname = 'blatools.selection_sets_export'
+    bl_label = "Export Selection Sets"
+    bl_options = {'REGISTER'}
+
+    filepath: bpy.props.StringProperty(name="Library", subtype='FILE_PATH', default="")
+    rigs: bpy.props.EnumProperty(
+        name="Rigs",
+        items=[
+            ('SELECTED', "Selected Rigs", "Sets of the active and selected rigs"),
+            ('ALL', "All Rigs", "Sets of all rigs in the scene")
+        ],
+        default='SELECTED'
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene.blatools.selection_sets
+
+    def execute(self, context):
+        filepath = bpy.path.abspath(self.filepath) if self.filepath else bla.selection_sets_library_path(context)
+        try:
+            count = bla.selection_sets_library_save(context, filepath, selection_sets_library_rigs(context, self.rigs))
+        except (OSError, ValueError) as error:
+            self.report({'ERROR'}, "Could not write library: " + str(error))
+            return {'CANCELLED'}
+        self.report({'INFO'}, str(count) + " selection sets exported to " + filepath)
+        return {"FINISHED"}
+
+class BLATOOLS_OT_SelectionSetsImport(bpy.types.Operator):
+    """Import selection sets from the selection set library"""
+    bl_idname = 'blatools.selection_sets_import'
+    bl_label = "Import Selection Sets"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    filepath: bpy.props.StringProperty(name="Library", subtype='FILE_PATH', default="")
+    rigs: bpy.props.EnumProperty(
+        name="Rigs",
+        items=[
+            ('SELECTED', "Selected Rigs", "Sets for the active and selected rigs"),
+            ('ALL', "All Rigs", "Sets for all rigs in the scene")
+        ],
+        default='SELECTED'
+    )
+
+    def execute(self, context):
+        filepath = bpy.path.abspath(self.filepath) if self.filepath else bla.selection_sets_library_path(context)
+        try:
+            count = bla.selection_sets_library_apply(context, filepath, selection_sets_library_rigs(context, self.rigs))
+        except (OSError, ValueError) as error:
+            self.report({'ERROR'}, "Could not read library: " + str(error))
+            return {'CANCELLED'}
         bla.ui_redraw()
+        self.report({'INFO'}, str(count) + " selection sets imported from " + filepath)
         return {"FINISHED"}
 
 class BLATOOLS_OT_AnimationDataInitialize(bpy.types.Operator):
@@ -159,6 +159,8 @@ class BLATOOLS_PT_MotionPaths(bpy.types.Panel):
         else:
             row.operator('object.paths_update',text="Update",icon='PHYSICS')
             row.operator('object.paths_clear',text="Clear",icon='PANEL_CLOSE')
+        row = layout.row()
+        row.operator('pose.motionpath_update_edited',text="Update Edited Keys",icon='FILE_REFRESH')
 
 class BLATOOLS_PT_TransformHelpers(bpy.types.Panel):
 
@@ -174,6 +176,16 @@ class BLATOOLS_PT_TransformHelpers(bpy.types.Panel):
         row.operator('object.transform_store', icon='ORIENTATION_CURSOR')
         row.operator('object.transform_paste', icon='GIZMO')
 
+class BLATOOLS_UL_AlphaLayers(bpy.types.UIList):
+    """Viewport alpha layers, one per collection"""
+
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
+        row = layout.row(align=True)
+        row.label(text=item.name, icon='GROUP' if item.collection else 'ERROR')
+        row.prop(item, 'alpha', text="", slider=True)
+        row.prop(item, 'drivers', text="", icon='DRIVER')
+        row.operator('blatools.collection_alpha_remove', text="", icon='X', emboss=False).position = index
+
 class BLATOOLS_PT_ViewportAlpha(bpy.types.Panel):
 
     bl_category = "blaTools"
@@ -184,20 +196,15 @@ class BLATOOLS_PT_ViewportAlpha(bpy.types.Panel):
     bl_order = 60
 
     def draw(self,context):
-        blatools = context.window_manager.blatools
+        scene_blatools = context.scene.blatools
         layout = self.layout
 
         box = layout.box()
         row = box.row()
-        if blatools.collection_alpha_collection:
-            alpha_text = blatools.collection_alpha_collection
-            alpha_icon = 'GROUP'
-        else:
-            alpha_text = "Select Collection"
-            alpha_icon = 'DOWNARROW_HLT'
-        row.operator('blatools.collection_alpha_select',text=alpha_text,icon=alpha_icon)
-        row = box.row()
-        row.prop(blatools, 'collection_alpha',slider=True)
+        row.operator('blatools.collection_alpha_select',text="Add Collection",icon='ADD')
+        if scene_blatools.alpha_layers:
+            row = box.row()
+            row.template_list('BLATOOLS_UL_AlphaLayers', "", scene_blatools, 'alpha_layers', scene_blatools, 'alpha_layers_index', rows=2)
         row = box.row()
         row.operator('blatools.collection_alpha_reset',text='Reset All Alphas',icon='HIDE_OFF')
 
@@ -229,11 +236,17 @@ class BLATOOLS_PT_SelectionSetsOptions(bpy.types.Panel):
         row.prop(blatools, 'selection_sets_new_name', text="New")
         row.operator('blatools.selection_sets_name_clear', text="", icon='X')
         row.emboss = 'NONE'
+        row = layout.row(align=True)
+        row.prop(blatools, 'selection_sets_mode', text="")
+        if blatools.selection_sets_mode != 'STATIC':
+            row.prop(blatools, 'selection_sets_pattern', text="")
         row = layout.row()
         row.prop(blatools, 'selection_sets_icons')
         sel_set_create = row.operator('blatools.selection_sets_create',text="Create",icon='PLUS')
         sel_set_create.selection_set = blatools.selection_sets_new_name
         sel_set_create.icon = blatools.selection_sets_icons
+        sel_set_create.mode = blatools.selection_sets_mode
+        sel_set_create.pattern = blatools.selection_sets_pattern
 
         box = layout.box()
         row = box.row()
@@ -257,6 +270,48 @@ class BLATOOLS_PT_SelectionSetsOptions(bpy.types.Panel):
         row = box.row()
         row.prop(blatools, 'selection_sets_make_active', text="Activate")
 
+        row = layout.row(align=True)
+        row.operator('blatools.selection_sets_import', text="Import", icon='IMPORT')
+        row.operator('blatools.selection_sets_export', text="Export", icon='EXPORT')
+
+class BLATOOLS_UL_SelectionSets(bpy.types.UIList):
+
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname, index):
+        blatools = context.window_manager.blatools
+        rows = bla.selection_sets_model(context.scene)['rows']
+        sel_set, sel_set_icon = rows[index] if index < len(rows) else (item.name, item.icon)
+        if self.layout_type == 'GRID':
+            layout.alignment = 'CENTER'
+            layout.label(text="", icon=sel_set_icon)
+            return
+        row = layout.row(align=True)
+        if blatools.selection_sets_edit:
+            sel_set_update_icon = row.operator('blatools.selection_sets_update_icon',text="", icon=sel_set_icon, emboss=False)
+            sel_set_update_icon.selection_set = sel_set
+            row.label(text=sel_set)
+        else:
+            sel_set_select = row.operator('pose.selection_sets_select',text=sel_set,icon=sel_set_icon)
+            sel_set_select.position = index
+            sel_set_select.clear = True
+            sel_set_select.select = True
+            sel_set_select = row.operator('pose.selection_sets_select',text="",icon='SELECT_EXTEND')
+            sel_set_select.position = index
+            sel_set_select.clear = False
+            sel_set_select.select = True
+            sel_set_select = row.operator('pose.selection_sets_select',text="",icon='SELECT_SUBTRACT')
+            sel_set_select.position = index
+            sel_set_select.clear = False
+            sel_set_select.select = False
+
+    def filter_items(self, context, data, propname):
+        return bla.selection_sets_filter(
+            context.scene,
+            self.bitflag_filter_item,
+            self.filter_name,
+            self.use_filter_invert,
+            self.use_filter_sort_alpha
+        )
+
 class BLATOOLS_PT_SelectionSets(bpy.types.Panel):
 
     bl_category = "blaTools"
@@ -267,51 +322,55 @@ class BLATOOLS_PT_SelectionSets(bpy.types.Panel):
 
     @classmethod
     def poll(cls, context):
-        return 'blatools_selection_sets' in context.scene
+        return context.scene.blatools.selection_sets
 
     def draw(self,context):
         blatools = context.window_manager.blatools
-        layout = self.layout      
-        length = len(context.scene['blatools_selection_sets'])
-        sorted_sets = [None] * len(context.scene['blatools_selection_sets'])
-        for sel_enum in context.scene['blatools_selection_sets']:
-            sorted_sets[context.scene['blatools_selection_sets'][sel_enum]['position']] = sel_enum
-        
-        for sel_set in sorted_sets:
-            i = dict(context.scene['blatools_selection_sets'][sel_set])['position']
-            row = layout.row(align=True)
-            sel_set_icon = dict(context.scene['blatools_selection_sets'][sel_set])['icon']
-            if blatools.selection_sets_edit:
-                sel_set_list = row.operator('blatools.selection_sets_list',text="", icon='INFO')
+        scene_blatools = context.scene.blatools
+        layout = self.layout
+        row = layout.row()
+        row.template_list(
+            'BLATOOLS_UL_SelectionSets', "",
+            scene_blatools, 'selection_sets',
+            scene_blatools, 'selection_sets_index',
+            rows=6 if blatools.selection_sets_edit else 5
+        )
+        if blatools.selection_sets_edit:
+            rows = bla.selection_sets_model(context.scene)['rows']
+            i = scene_blatools.selection_sets_index
+            if 0 <= i < len(rows):
+                sel_set = rows[i][0]
+                col = row.column(align=True)
+                sel_set_list = col.operator('blatools.selection_sets_list',text="", icon='INFO')
                 sel_set_list.selection_set = sel_set
-                sel_set_update_icon = row.operator('blatools.selection_sets_update_icon',text="", icon=sel_set_icon)
-                sel_set_update_icon.selection_set = sel_set
-                sel_set_select = row.operator('pose.selection_sets_select',text=sel_set)
-                sel_set_select.position = i
-                sel_set_select.clear = True
-                sel_set_select.select = True
-                if i + 1 < length:
-                    sel_set_move_down = row.operator('blatools.selection_sets_reorder',text="", icon='SORT_ASC')
-                    sel_set_move_down.up = False
-                    sel_set_move_down.position = i
-                if i > 0:
-                    sel_set_move_up = row.operator('blatools.selection_sets_reorder',text="", icon='SORT_DESC')
-                    sel_set_move_up.up = True
-                    sel_set_move_up.position = i
-                sel_set_update = row.operator('blatools.selection_sets_update',text="",icon='CON_ROTLIMIT')
+                sel_set_update = col.operator('blatools.selection_sets_update',text="",icon='CON_ROTLIMIT')
                 sel_set_update.selection_set = sel_set
-                sel_set_delete = row.operator('blatools.selection_sets_delete',text="",icon='CANCEL')
+                col.separator()
+                sub = col.column(align=True)
+                sub.enabled = i > 0
+                sel_set_move_up = sub.operator('blatools.selection_sets_reorder',text="", icon='TRIA_UP')
+                sel_set_move_up.up = True
+                sel_set_move_up.position = i
+                sub = col.column(align=True)
+                sub.enabled = i + 1 < len(rows)
+                sel_set_move_down = sub.operator('blatools.selection_sets_reorder',text="", icon='TRIA_DOWN')
+                sel_set_move_down.up = False
+                sel_set_move_down.position = i
+                col.separator()
+                sel_set_delete = col.operator('blatools.selection_sets_delete',text="",icon='CANCEL')
                 sel_set_delete.selection_set = sel_set
-            else:
-                sel_set_select = row.operator('pose.selection_sets_select',text=sel_set,icon=sel_set_icon)
-                sel_set_select.position = i
-                sel_set_select.clear = True
-                sel_set_select.select = True
-                sel_set_select = row.operator('pose.selection_sets_select',text="",icon='SELECT_EXTEND')
-                sel_set_select.position = i
-                sel_set_select.clear = False
-                sel_set_select.select = True
-                sel_set_select = row.operator('pose.selection_sets_select',text="",icon='SELECT_SUBTRACT')
-                sel_set_select.position = i
-                sel_set_select.clear = False
-                sel_set_select.select = False
\ No newline at end of file
+
+        row = layout.row(align=True)
+        row.prop(blatools, 'selection_sets_expression', text="", icon='SELECT_INTERSECT')
+        sel_set_combine = row.operator('pose.selection_sets_combine', text="", icon='RESTRICT_SELECT_OFF')
+        sel_set_combine.expression = blatools.selection_sets_expression
+        sel_set_combine.clear = True
+        sel_set_combine.select = True
+        sel_set_combine = row.operator('pose.selection_sets_combine', text="", icon='SELECT_EXTEND')
+        sel_set_combine.expression = blatools.selection_sets_expression
+        sel_set_combine.clear = False
+        sel_set_combine.select = True
+        sel_set_combine = row.operator('pose.selection_sets_combine', text="", icon='SELECT_SUBTRACT')
+        sel_set_combine.expression = blatools.selection_sets_expression
+        sel_set_combine.clear = False
+        sel_set_combine.select = False
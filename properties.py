@@ -2,6 +2,53 @@ import bpy
 
 from . import blatools as bla
 
+selection_set_modes = (
+    ('STATIC', "Static", "Fixed list of the selected bones", 'PINNED', 0),
+    ('GLOB', "Glob", "Bones with names matching wildcard patterns, separated by commas", 'FILTER', 1),
+    ('REGEX', "Regex", "Bones with names matching a regular expression", 'SORTALPHA', 2),
+    ('COLLECTION', "Collection", "Bones in bone collections or bone groups, separated by commas", 'GROUP_BONE', 3)
+)
+
+class blaToolsSelectionSetBone(bpy.types.PropertyGroup):
+    active: bpy.props.BoolProperty(default=False, name="Active")
+
+class blaToolsSelectionSet(bpy.types.PropertyGroup):
+    icon: bpy.props.StringProperty(default='BLANK1', name="Icon")
+    source: bpy.props.StringProperty(default="", name="Source Rig")
+    mode: bpy.props.EnumProperty(name="Mode", items=selection_set_modes, default='STATIC')
+    pattern: bpy.props.StringProperty(default="", name="Pattern")
+    bones: bpy.props.CollectionProperty(type=blaToolsSelectionSetBone, name="Bones")
+
+class blaToolsAlphaSnapshot(bpy.types.PropertyGroup):
+    target: bpy.props.PointerProperty(type=bpy.types.ID, name="Datablock")
+    kind: bpy.props.EnumProperty(name="Kind",
+        items=(
+                ('COLOR', "Object Color", "Object color alpha"),
+                ('IMAGE', "Image Alpha", "Image empty alpha toggle"),
+                ('STROKE', "Stroke", "Grease pencil stroke alpha"),
+                ('FILL', "Fill", "Grease pencil fill alpha"),
+                ('DIFFUSE', "Diffuse", "Material viewport alpha"),
+                ('SLOT', "Material Slot", "Empty material slots filled with a ghost material"),
+                ('APPEND', "Appended Slot", "Ghost material appended to data without material slots"),
+                ('DRIVER', "Driver", "Alpha driven by a ghost material"),
+                ('GHOST', "Ghost Material", "Pooled material created for collection alpha, removed on reset")
+            ),
+        default='COLOR')
+    value: bpy.props.FloatProperty(name="Original Value")
+
+class blaToolsAlphaLayer(bpy.types.PropertyGroup):
+    collection: bpy.props.PointerProperty(type=bpy.types.Collection, name="Collection")
+    alpha: bpy.props.FloatProperty(name="Alpha", min=0.0, max=1.0, default=1.0, soft_min=0.0, soft_max=1.0, update=bla.alpha_layer_update)
+    ghost: bpy.props.PointerProperty(type=bpy.types.Material, name="Ghost Material")
+    drivers: bpy.props.BoolProperty(name="Drivers", description="Drive the alpha of the collection by its ghost material, changing it is a single property write", default=False, update=bla.alpha_layer_drivers_update)
+
+class blaToolsSceneSettings(bpy.types.PropertyGroup):
+    selection_sets: bpy.props.CollectionProperty(type=blaToolsSelectionSet, name="Selection Sets")
+    selection_sets_index: bpy.props.IntProperty(default=0, name="Active Selection Set")
+    alpha_snapshots: bpy.props.CollectionProperty(type=blaToolsAlphaSnapshot, name="Alpha Snapshots")
+    alpha_layers: bpy.props.CollectionProperty(type=blaToolsAlphaLayer, name="Alpha Layers")
+    alpha_layers_index: bpy.props.IntProperty(default=0, name="Active Alpha Layer")
+
 class blaToolsSettings(bpy.types.PropertyGroup):
     selection_sets_new_name: bpy.props.StringProperty(default="", name="Name")
     selection_sets_icons: bpy.props.EnumProperty(name="Icon",
@@ -19,6 +66,9 @@ class blaToolsSettings(bpy.types.PropertyGroup):
                 ('COLORSET_10_VEC', "Black", "Black", 'COLORSET_10_VEC', 10)
             ),
         default='BLANK1')
+    selection_sets_mode: bpy.props.EnumProperty(name="Mode", items=selection_set_modes, default='STATIC')
+    selection_sets_pattern: bpy.props.StringProperty(default="", name="Pattern")
+    selection_sets_expression: bpy.props.StringProperty(default="", name="Expression")
     selection_sets_warnings: bpy.props.BoolProperty(default=True, name="Warnings")
     selection_sets_edit: bpy.props.BoolProperty(default=False, name="Edit")
     selection_sets_filter_rig: bpy.props.StringProperty(default='SOURCE', name="Filter")
@@ -28,13 +78,31 @@ class blaToolsSettings(bpy.types.PropertyGroup):
                 ('SET', "Active Set Bone", "Apply active set bone", 'PIVOT_ACTIVE', 1),
             ),
         default='SET')
-    collection_alpha_collection: bpy.props.StringProperty(name="Collection",default="")
-    collection_alpha: bpy.props.FloatProperty(name="Collection Alpha",min=0.0, max=1.0, default=1.0, soft_min=0.0, soft_max=1.0, update=bla.collection_alpha_set)
     transform_tmp: bpy.props.FloatVectorProperty(
         name='Transform Store',
         description='Temporary Transform Matrix Storage',
         size=16
     )
 
+class blaToolsPreferences(bpy.types.AddonPreferences):
+    bl_idname = __package__
+
+    selection_sets_library: bpy.props.StringProperty(
+        name="Selection Set Library",
+        description="JSON file shared selection sets are exported to and imported from, per rig name. Leave empty to use the user config folder",
+        subtype='FILE_PATH',
+        default=""
+    )
+
+    def draw(self, context):
+        self.layout.prop(self, 'selection_sets_library')
+
 bpy.utils.register_class(blaToolsSettings)
-bpy.types.WindowManager.blatools = bpy.props.PointerProperty(type=blaToolsSettings, name="blaTools")
\ No newline at end of file
+bpy.utils.register_class(blaToolsPreferences)
+bpy.utils.register_class(blaToolsSelectionSetBone)
+bpy.utils.register_class(blaToolsSelectionSet)
+bpy.utils.register_class(blaToolsAlphaSnapshot)
+bpy.utils.register_class(blaToolsAlphaLayer)
+bpy.utils.register_class(blaToolsSceneSettings)
+bpy.types.WindowManager.blatools = bpy.props.PointerProperty(type=blaToolsSettings, name="blaTools")
+bpy.types.Scene.blatools = bpy.props.PointerProperty(type=blaToolsSceneSettings, name="blaTools")